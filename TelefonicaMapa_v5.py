@@ -1,102 +1,117 @@
 # Dataset Telefónica
 # María José Vota, Eugenia Rendón, Alan Velasco, Martha Elena García
 
+import os
+import threading
+
+import flask
+
 import pandas as pd
 import numpy as np
 import humanize 
 import plotly.graph_objs as go
-from datetime import datetime as dt
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-
-print("Cargando dataset")
-# Initialize data frame
-df = pd.read_csv("DataSet_Telefonica.csv")
-# eliminar instancias con nulls (20)
-df = df.dropna()
-
-print("Limpiando valores")
-# convertir formato de fecha: string -> datetime
-df["fecha"] = pd.to_datetime(df["fecha"], format="%Y-%m-%d")
-# convertir formato de hora: float -> int
-df["hora"] = df["hora"].astype(int)
-# Convertir tipos de plan
-df["plan"] = df["plan"].astype("category")
-print("Construyendo Sankey")
-unpopular_plans = list(
-    ("GU", "MY", "DD", "KO", "HA", "HW", "NB", "Z2", "DC", "Z7", "DH", "JQ")
-)
-unpopular_plans.extend(
-    ("HX", "HU", "J3", "KB", "FQ", "FD", "HT", "CS", "LQ", "FO", "CH", "L0")
-)
-unpopular_plans.extend(
-    ("FN", "HV", "KK", "BF", "FM", "GG", "FA", "ZR", "HM", "GO", "R2", "HO")
-)
-unpopular_plans.extend(("ZM", "Q9", "FP", "HH", "HC", "OZ", "KI", "MZ", "GH", "QG"))
-
-df["plan"].cat.remove_categories(unpopular_plans, inplace=True)
-df["plan"].cat.add_categories(["Otro"], inplace=True)
-df["plan"].fillna("Otro", inplace=True)
-# informacion sitio
-sitios = df[["sitio", "latitud", "longitud"]].drop_duplicates()
-
-
-# Data Frame para Sankey
-
-# Agrupar por tecnologia,tipo plan y plan
-dfsankey2 = df.groupby(["tecnologia", "tipo_plan"], as_index=False)["sum_bytes"].count()
-dfsankey3 = df.groupby(["tipo_plan", "plan"], as_index=False)["sum_bytes"].count()
-dfsankey2.columns = ["a", "b", "Quantity"]
-dfsankey3.columns = ["a", "b", "Quantity"]
-dfsankey = dfsankey2.append(dfsankey3)
-
-# Agregar source y target del sankey
-all_nodes = dfsankey.a.values.tolist() + dfsankey.b.values.tolist()
-source_indices = [all_nodes.index(a) for a in dfsankey.a]
-target_indices = [all_nodes.index(b) for b in dfsankey.b]
-
-# graficar sankey
-fig = go.Figure(
-    data=[
-        go.Sankey(
-            node=dict(
-                pad=20,
-                thickness=20,
-                line=dict(color="black", width=1.0),
-                label=all_nodes,
-            ),
-            link=dict(
-                source=source_indices, target=target_indices, value=dfsankey.Quantity,
-            ),
-        )
-    ]
-)
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 
-fig.update_layout(
-    title_text="Tecnologias y Planes en Telefonica",
-    font=dict(size=10, color="white"),
-    plot_bgcolor="red",
-    paper_bgcolor="#343332",
+try:
+    from dash import Patch
+except ImportError:
+    # Dash sin actualizaciones parciales: siempre se envia la figura completa
+    Patch = None
+
+import datos
+import sankey
+from cubo import cargar_cubo, cargar_diario, cargar_horario, seleccion
+from espacial import (
+    ZOOM_SITIOS,
+    IndiceSitios,
+    Rejilla,
+    ampliar,
+    caja_derivada,
+    caja_vista,
+    contiene,
 )
+import consultas
+import metricas
+from memo import CacheCallbacks
+from payloads import BINARIO, MedidorPayloads, arreglo, empacar
+from voronoi import cargar_voronoi
 
-print("Agrupando por semana")
+# Modo cliente: el navegador recibe el cubo una vez por sesion y filtra
+# localmente, sin ida y vuelta al servidor por cada cambio de filtro
+MODO_CLIENTE = os.environ.get("TELEFONICA_MODO_CLIENTE") == "1"
+
+# Backend de las consultas por rango de fechas (mapa, histograma, Voronoi):
+# "cubo" (sumas acumuladas por dia) o "duckdb" (sobre las particiones por
+# fecha del dataset, para datos que no caben en memoria). El modo cliente
+# necesita el cubo diario en cualquier caso.
+FUERA_DE_MEMORIA = consultas.fuera_de_memoria(os.environ.get("TELEFONICA_BACKEND", "cubo"))
+USAR_DIARIO = MODO_CLIENTE or not FUERA_DE_MEMORIA
+
+# Peso de los enlaces del Sankey: "registros" o "sum_bytes"
+PESO_SANKEY = sankey.validar_peso(os.environ.get("TELEFONICA_PESO_SANKEY", "registros"))
+
+# Datos de la app. Los carga crear_app: en un hilo aparte con el servidor
+# de desarrollo, para que responda (con un estado de carga) desde el
+# arranque, o antes de crear los workers con un servidor WSGI.
+estado = {"listo": False, "error": None}
+
+
+def cargar_datos():
+    try:
+        with metricas.etapas.medir("carga_datos"):
+            # Dataset limpio y pre-agregado (desde cache si el CSV no ha cambiado);
+            # los pasos siguientes lo leen por archivos solo si hay que
+            # reconstruir su cache
+            sitios = datos.cargar_dataset()
+            # Sankey de tecnologias y planes
+            fig = sankey.cargar_sankey(peso=PESO_SANKEY)
+            # Cubo (semana, tecnologia, tipo_plan, sitio), a partir del
+            # DataFrame agrupado por semana
+            cubo = cargar_cubo(sitios)
+            # Sumas acumuladas por dia para rangos de fechas arbitrarios, o
+            # consultas sobre el Parquet sin construir el cubo diario
+            diario = cargar_diario(cubo) if USAR_DIARIO else None
+            consulta = diario
+            if FUERA_DE_MEMORIA:
+                # Mismo eje de sitios (sin repetidos) que el cubo
+                consulta = consultas.cargar_consulta_duckdb(cubo.sitios)
+            # Celdas de sitios por nivel de zoom para el mapa
+            rejilla = Rejilla(cubo.sitios)
+            # Sitios por celda fija, para recortar el mapa a la vista
+            indice = IndiceSitios(cubo.sitios)
+            # Consumo por sitio, dia y hora para el mapa de calor; con duckdb
+            # se consulta sobre las particiones, sin el cubo horario en memoria
+            horario = consulta if FUERA_DE_MEMORIA else cargar_horario(cubo)
+            # Poligonos de Voronoi de los sitios (None sin scipy)
+            teselacion = cargar_voronoi(cubo.sitios)
+    except Exception as e:
+        estado["error"] = repr(e)
+        raise
+
+    estado.update(
+        sankey=fig,
+        cubo=cubo,
+        diario=diario,
+        consulta=consulta,
+        horario=horario,
+        rejilla=rejilla,
+        indice=indice,
+        teselacion=teselacion,
+        # Version de los datos, del codigo y del formato de los arreglos
+        # (binario o listas); invalida el cache de figuras
+        version=[datos.version_datos(), os.path.getmtime(__file__), BINARIO],
+        # Rango de fechas con datos, para el calendario y la pestaña de Analisis
+        fecha_min=pd.Timestamp(consulta.dias[0]),
+        fecha_max=pd.Timestamp(consulta.dias[-1]),
+    )
+    estado["listo"] = True
+    print("Datos listos")
 
-# DataFrame agrupado por semana
-grouped = df.groupby(["sitio", "tipo_plan", "tecnologia", "fecha"]).agg(
-    {"sum_bytes": "sum"}
-)
-grouped = grouped.reset_index()
-# grouped = grouped.set_index("fecha")
-df_master = grouped.groupby(
-    ["sitio", "tipo_plan", "tecnologia", pd.Grouper(key="fecha", freq="W-mon")]
-).sum()
-df_master = df_master.reset_index()
-df_master = pd.merge(df_master, sitios, on="sitio", how="left")
-df_master = df_master.reset_index()
-df = df_master
 
 # Diccionario de ubicaciones importantes en MTY
 list_of_locations = {
@@ -112,14 +127,132 @@ list_of_locations = {
     "Tec de MTY": {"lat": 25.6514, "lon": -100.2895},
 }
 
+meses = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio",
+    "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre",
+]
+
+
+def texto_fecha(fecha, con_anio=True):
+    texto = "{} {}".format(meses[fecha.month - 1], fecha.day)
+    return texto + ", {}".format(fecha.year) if con_anio else texto
+
+
+def texto_instancias(fecha_min, fecha_max):
+    # p. ej. "Instancias de: Octubre 4 - Noviembre 5, 2019"
+    return "Instancias de: {} - {}".format(
+        texto_fecha(fecha_min, con_anio=fecha_min.year != fecha_max.year),
+        texto_fecha(fecha_max),
+    )
+
+
+def figura_cargando():
+    # Figura vacia mientras se construyen los datos
+    return figura_mensaje("Cargando datos...")
+
+
+def figura_mensaje(texto):
+    return go.Figure(
+        layout=go.Layout(
+            plot_bgcolor="#323130",
+            paper_bgcolor="#323130",
+            xaxis=dict(visible=False),
+            yaxis=dict(visible=False),
+            annotations=[
+                dict(
+                    text=texto,
+                    showarrow=False,
+                    font=dict(color="white", size=16),
+                )
+            ],
+        )
+    )
+
+
 mapbox_access_token = (
     "pk.eyJ1IjoibWFyaWFqb3NldnoiLCJhIjoiY2s5OTU1OXRq"
     "MDh6bDNubngxaWVyMmZ0aiJ9.2-Wv-0scEzITavhaqSrUcA"
 )
-app = dash.Dash(__name__)
+# Respuestas comprimidas con gzip/brotli si esta instalado flask_compress
+try:
+    import flask_compress  # noqa: F401
+
+    comprimir = True
+except ImportError:
+    comprimir = False
+app = dash.Dash(__name__, compress=comprimir)
 app.title = 'Dash Telefonica'
 
 
+# Responde 200 cuando los datos estan listos y 503 mientras cargan
+@app.server.route("/ready")
+def ready():
+    if estado["listo"]:
+        return "ok"
+    if estado["error"]:
+        return estado["error"], 500
+    return "cargando", 503
+
+
+# Cache de figuras compartido por todos los usuarios y procesos
+memo = CacheCallbacks(
+    datos.ruta_cache("callbacks.sqlite"),
+    version=lambda: estado["version"] if estado["listo"] else None,
+)
+
+
+def llave_filtro(valor):
+    # Filtro de seleccion multiple en forma canonica para el cache: el
+    # orden en que se eligieron los valores no cambia el resultado
+    elegidos = seleccion(valor)
+    return None if elegidos is None else sorted(elegidos)
+
+
+def llave_fecha(fecha):
+    # La fecha puede llegar con o sin hora
+    return fecha[:10] if fecha else None
+
+
+def entradas_filtro(inicio, fin, *otros):
+    # version-datos (ultimo argumento) no se usa, la version se toma del servidor
+    return [llave_fecha(inicio), llave_fecha(fin)] + [llave_filtro(v) for v in otros[:-1]]
+
+
+# Aciertos y fallos del cache de callbacks
+@app.server.route("/cache")
+def cache_stats():
+    return flask.jsonify(memo.estadisticas())
+
+
+# Bytes que regresa cada callback, sin y con compresion
+medidor = MedidorPayloads()
+medidor.registrar(app.server)
+
+
+@app.server.route("/payloads")
+def payloads_stats():
+    return flask.jsonify(medidor.estadisticas())
+
+
+# Latencia de los callbacks. TELEFONICA_CALLBACK_LENTO_MS=500 anexa las
+# llamadas mas lentas, con sus entradas, a cache/callbacks_lentos.jsonl
+umbral_lento = os.environ.get("TELEFONICA_CALLBACK_LENTO_MS")
+latencias = metricas.MetricasCallbacks(
+    umbral_lento=float(umbral_lento) / 1000 if umbral_lento else None,
+    ruta_lentos=datos.ruta_cache("callbacks_lentos.jsonl"),
+)
+latencias.registrar(app.server)
+
+
+# Etapas de carga, latencias, bytes y cache en formato de Prometheus
+@app.server.route("/metrics")
+def metrics():
+    return flask.Response(
+        metricas.texto(latencias, medidor.estadisticas(), memo.estadisticas()),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 # Tab Style
 
 tabs_styles = {
@@ -144,7 +277,7 @@ tab_selected_style = {
 company_logo = html.Img(className="logo", src=app.get_asset_url("telefonica-logo.png"))
 title = html.H2("Análisis de Tráfico de Datos")
 instructions = html.P(
-    "Seleccione el lunes de la semana que desea visualizar utilizando el calendario."
+    "Seleccione el rango de fechas que desea visualizar utilizando el calendario."
 )
 
 # Tab 1 - Analisis
@@ -162,14 +295,14 @@ analysis_tab = dcc.Tab(
                     children=[
                         company_logo,
                         html.H2("Análisis exploratorio"),
-                        html.P("""Instancias de: Octubre 4 - Noviembre 5, 2019""",),
-                        html.P("""614 Radio Bases"""),
+                        html.P("Cargando datos...", id="texto-instancias"),
+                        html.P(id="texto-sitios"),
                         html.P(""" TEC de MTY, 2020"""),
                     ],
                 ),
                 html.Div(
                     className="eight columns div-for-chart bg-grey",
-                    children=[dcc.Graph(figure=fig),],
+                    children=[dcc.Graph(id="sankey-graph", figure=figura_cargando()),],
                 ),
             ],
         ),
@@ -180,12 +313,12 @@ analysis_tab = dcc.Tab(
 date_dropdown = html.Div(
     className="div-for-dropdown",
     children=[
-        dcc.DatePickerSingle(
+        dcc.DatePickerRange(
             id="date-picker",
-            min_date_allowed=dt(2019, 10, 4),
-            max_date_allowed=dt(2019, 11, 5),
-            initial_visible_month=dt(2019, 10, 4),
             display_format="MMMM D, YYYY",
+            start_date_placeholder_text="Desde",
+            end_date_placeholder_text="Hasta",
+            clearable=True,
             style={"border": "0px solid black"},
         )
     ],
@@ -203,15 +336,29 @@ locations_dropdown = html.Div(
     ],
 )
 
+# Radio alrededor de la ubicacion para el panel de consumo cercano
+radius_slider = html.Div(
+    className="div-for-dropdown",
+    children=[
+        dcc.Slider(
+            id="radio-km",
+            min=1,
+            max=20,
+            step=1,
+            value=5,
+            marks={km: "{} km".format(km) for km in (1, 5, 10, 15, 20)},
+        )
+    ],
+)
+
 # Dropdown para tipo de tecnologia
 tech_dropdown = html.Div(
     className="div-for-dropdown",
     children=[
         dcc.Dropdown(
             id="tech_name",
-            options=[
-                {"label": str(b), "value": b} for b in sorted(df["tecnologia"].unique())
-            ],
+            options=[],
+            multi=True,
             placeholder="Tipo de tecnología(s)",
         )
     ],
@@ -223,9 +370,8 @@ plan_dropdown = html.Div(
     children=[
         dcc.Dropdown(
             id="tipo_plan",
-            options=[
-                {"label": str(b), "value": b} for b in sorted(df["tipo_plan"].unique())
-            ],
+            options=[],
+            multi=True,
             placeholder="Tipo de plan(es)",
         )
     ],
@@ -241,7 +387,13 @@ sidebar_map = html.Div(
         # dropdowns
         html.Div(
             className="row",
-            children=[date_dropdown, locations_dropdown, tech_dropdown, plan_dropdown,],
+            children=[
+                date_dropdown,
+                locations_dropdown,
+                radius_slider,
+                tech_dropdown,
+                plan_dropdown,
+            ],
         ),
         # ultimas lineas
         dcc.Markdown(children=["TEC de MTY, 2020"]),
@@ -253,6 +405,11 @@ map_graph = html.Div(
     className="eight columns div-for-charts bg-grey",
     children=[
         dcc.Graph(id="map-graph", style={"backgroundColor": "#343332"}),
+        # Nivel de agregacion y puntos de la figura actual del mapa
+        dcc.Store(id="geometria-mapa"),
+        # Solo en modo cliente: cubo compacto y geometria del mapa
+        dcc.Store(id="cubo-cliente"),
+        dcc.Store(id="mapa-base"),
         html.Div(
             className="text-padding",
             children=html.P(
@@ -262,6 +419,8 @@ map_graph = html.Div(
             ),
         ),
         dcc.Graph(id="histogram"),
+        # Consumo por semana y tecnologia alrededor de la ubicacion elegida
+        dcc.Graph(id="radio-graph"),
     ],
 )
 
@@ -284,27 +443,220 @@ map_tab = dcc.Tab(
     ],
 )
 
-# Tab 3 - Voronoi
+# Tab 3 - Horas del dia
+hour_sidebar = html.Div(
+    className="four columns div-user-controls",
+    children=[
+        company_logo,
+        html.H2("Consumo por hora"),
+        html.P("Filtre por tecnología, tipo de plan y radio bases."),
+        html.Div(
+            className="row",
+            children=[
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.Dropdown(
+                            id="tech_horas",
+                            options=[],
+                            multi=True,
+                            placeholder="Tipo de tecnología(s)",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.Dropdown(
+                            id="plan_horas",
+                            options=[],
+                            multi=True,
+                            placeholder="Tipo de plan(es)",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.Dropdown(
+                            id="sitio_horas",
+                            options=[],
+                            multi=True,
+                            placeholder="Radio base(s)",
+                        )
+                    ],
+                ),
+            ],
+        ),
+        dcc.Markdown(children=["TEC de MTY, 2020"]),
+    ],
+)
+
+hour_tab = dcc.Tab(
+    label="Horas",
+    style=tab_style,
+    selected_style=tab_selected_style,
+    children=[
+        html.Div(
+            className="row",
+            children=[
+                hour_sidebar,
+                html.Div(
+                    className="eight columns div-for-charts bg-grey",
+                    children=[dcc.Graph(id="heatmap", style={"height": "90vh"})],
+                ),
+            ],
+        )
+    ],
+)
+
+# Tab 4 - Voronoi
+voronoi_sidebar = html.Div(
+    className="four columns div-user-controls",
+    children=[
+        company_logo,
+        html.H2("Cobertura"),
+        html.P("Área más cercana a cada radio base, coloreada por su consumo."),
+        html.Div(
+            className="row",
+            children=[
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.DatePickerRange(
+                            id="fecha_voronoi",
+                            display_format="MMMM D, YYYY",
+                            start_date_placeholder_text="Desde",
+                            end_date_placeholder_text="Hasta",
+                            clearable=True,
+                            style={"border": "0px solid black"},
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.Dropdown(
+                            id="tech_voronoi",
+                            options=[],
+                            multi=True,
+                            placeholder="Tipo de tecnología(s)",
+                        )
+                    ],
+                ),
+                html.Div(
+                    className="div-for-dropdown",
+                    children=[
+                        dcc.Dropdown(
+                            id="plan_voronoi",
+                            options=[],
+                            multi=True,
+                            placeholder="Tipo de plan(es)",
+                        )
+                    ],
+                ),
+            ],
+        ),
+        dcc.Markdown(children=["TEC de MTY, 2020"]),
+    ],
+)
+
 voronoi_tab = dcc.Tab(
     label="Voronoi",
     style=tab_style,
     selected_style=tab_selected_style,
-    children=[html.Iframe(src="voronoi.html", sandbox="allow-scripts")],
+    children=[
+        html.Div(
+            className="row",
+            children=[
+                voronoi_sidebar,
+                html.Div(
+                    className="eight columns div-for-charts bg-grey",
+                    children=[
+                        dcc.Graph(id="voronoi-graph", style={"height": "90vh"}),
+                        # Version de los poligonos que ya tiene el navegador
+                        dcc.Store(id="geometria-voronoi"),
+                    ],
+                ),
+            ],
+        )
+    ],
 )
 
 
 # Layout of Dash app
 app.layout = html.Div(
-    children=[dcc.Tabs(children=[analysis_tab, map_tab, voronoi_tab], style=tabs_styles)]
+    children=[
+        dcc.Tabs(
+            children=[analysis_tab, map_tab, hour_tab, voronoi_tab], style=tabs_styles
+        ),
+        # Revisa cada segundo si ya terminaron de cargar los datos
+        dcc.Interval(id="carga", interval=1000),
+        dcc.Store(id="version-datos"),
+    ]
+)
+
+
+# Al terminar la carga llena los controles que dependen de los datos
+# y avisa a los demas callbacks a traves de version-datos
+@app.callback(
+    [
+        Output("carga", "disabled"),
+        Output("version-datos", "data"),
+        Output("sankey-graph", "figure"),
+        Output("texto-instancias", "children"),
+        Output("texto-sitios", "children"),
+        Output("date-picker", "min_date_allowed"),
+        Output("date-picker", "max_date_allowed"),
+        Output("date-picker", "initial_visible_month"),
+        Output("tech_name", "options"),
+        Output("tipo_plan", "options"),
+        Output("tech_horas", "options"),
+        Output("plan_horas", "options"),
+        Output("sitio_horas", "options"),
+        Output("fecha_voronoi", "min_date_allowed"),
+        Output("fecha_voronoi", "max_date_allowed"),
+        Output("fecha_voronoi", "initial_visible_month"),
+        Output("tech_voronoi", "options"),
+        Output("plan_voronoi", "options"),
+    ],
+    [Input("carga", "n_intervals")],
 )
+def revisar_carga(n_intervals):
+    if estado["error"]:
+        return [True, dash.no_update, dash.no_update, "Error al cargar los datos"] + [
+            dash.no_update
+        ] * 14
+    if not estado["listo"]:
+        raise PreventUpdate
+    cubo = estado["cubo"]
+    tecnologias = [{"label": str(b), "value": b} for b in cubo.tecnologias]
+    planes = [{"label": str(b), "value": b} for b in cubo.planes]
+    return [
+        True,
+        1,
+        estado["sankey"],
+        texto_instancias(estado["fecha_min"], estado["fecha_max"]),
+        "{} Radio Bases".format(len(cubo.sitios)),
+        estado["fecha_min"].strftime("%Y-%m-%d"),
+        estado["fecha_max"].strftime("%Y-%m-%d"),
+        estado["fecha_min"].strftime("%Y-%m-%d"),
+        tecnologias,
+        planes,
+        tecnologias,
+        planes,
+        [{"label": s, "value": s} for s in estado["horario"].sitios],
+        estado["fecha_min"].strftime("%Y-%m-%d"),
+        estado["fecha_max"].strftime("%Y-%m-%d"),
+        estado["fecha_min"].strftime("%Y-%m-%d"),
+        tecnologias,
+        planes,
+    ]
 
 
-def get_selection(pickedDate, pickedTech, pickedPlan):
+def get_selection(startDate, endDate, pickedTech, pickedPlan):
     # Obtener cantidad de bytes por semana.
     # Pinta de otro color la barra seleccionada
-    xVal = []
-    yVal = []
-    xSelected = []
     colorVal = [
         "#F4EC15",
         "#66E01F",
@@ -314,50 +666,28 @@ def get_selection(pickedDate, pickedTech, pickedPlan):
         "#2E4EA4",
     ]
 
-    # Create new df for sum of weekly sum bytes
-    df_subHist = df
-    if pickedDate is not None:
-        df_subHist = df_subHist[df_subHist["fecha"] == pickedDate]
-    if pickedTech is not None:
-        df_subHist = df_subHist[df_subHist["tecnologia"] == pickedTech]
-    if pickedPlan is not None:
-        df_subHist = df_subHist[df_subHist["tipo_plan"] == pickedPlan]
-
-    df_subHist = df_subHist.groupby([ "tipo_plan", "tecnologia", "fecha"]).agg({"sum_bytes": "sum"})
-    df_subHist = df_subHist.reset_index()
-
-    weeks = df['fecha'].unique()
-
-    #if week is not None:
-        #xSelected.extend([int(x) for x in week])
+    cubo = estado["cubo"]
 
-    # utilizando 4 semanas
-    for week in weeks:
-        # If bar is selected then color it white
-        #if i in xSelected and len(xSelected) < 10:
-            #colorVal[i] = "#FFFFFF"
-        xVal.append(np.datetime_as_string(week, unit='D'))
-        # CAMBIAR ESTO A SEMANAS
-        # Get the number of rides at a particular time
-	
-        yVal.append(df_subHist[df_subHist["fecha"] == week]["sum_bytes"].sum())
-    return [np.array(xVal), np.array(yVal), np.array(colorVal)]
+    # Bytes de cada semana dentro del rango, desde las sumas acumuladas
+    # por dia (dos renglones por semana, sin importar lo largo del rango)
+    yVal = estado["consulta"].por_semana(cubo.semanas, startDate, endDate, pickedTech, pickedPlan)
+    # Etiquetas de todas las semanas en una sola conversion
+    xVal = np.datetime_as_string(cubo.semanas, unit="D")
+    return [xVal, yVal, np.array(colorVal)]
 
 
 # Output de histograma
 # Update Histogram Figure based on Month, Day and Times Chosen
-@app.callback(
-    Output("histogram", "figure"),
-    [
-        Input("date-picker", "date"),
-        Input("tech_name", "value"),
-        Input("tipo_plan", "value"),
-    ],
-)
-def update_histogram(pickedWeek, pickedTech, pickedPlan):
+@memo.memoizar(entradas_filtro)
+def update_histogram(startDate, endDate, pickedTech, pickedPlan, version):
+    if not estado["listo"]:
+        return figura_cargando()
+
+    [xVal, yVal, colorVal] = get_selection(startDate, endDate, pickedTech, pickedPlan)
+    return figura_histograma(xVal, yVal, colorVal)
 
-    [xVal, yVal, colorVal] = get_selection(pickedWeek, pickedTech, pickedPlan)
 
+def figura_histograma(xVal, yVal, colorVal):
     layout = go.Layout(
         bargap=0.01,
         bargroupgap=0,
@@ -396,7 +726,7 @@ def update_histogram(pickedWeek, pickedTech, pickedPlan):
         ],
     )
 
-    return go.Figure(
+    fig = go.Figure(
         data=[
             go.Bar(x=list(range(len(xVal))), y=yVal, marker=dict(color=colorVal), hoverinfo="x"),
             go.Scatter(
@@ -411,44 +741,126 @@ def update_histogram(pickedWeek, pickedTech, pickedPlan):
         ],
         layout=layout,
     )
+    return empacar(fig, {(0, "x"): "i4", (0, "y"): "f8", (1, "y"): "f8"})
 
 
 # Output del mapa
-@app.callback(
-    Output("map-graph", "figure"),
-    [
-        Input("date-picker", "date"),
-        Input("location-dropdown", "value"),
-        Input("tech_name", "value"),
-        Input("tipo_plan", "value"),
-    ],
-)
-def update_graph(datePicked, selectedLocation, chosen_tech, chosen_plan):
-    df_sub = df
-    if datePicked is not None:
-        df_sub = df_sub[df_sub["fecha"] == datePicked]
-    if chosen_tech is not None:
-        df_sub = df_sub[df_sub["tecnologia"] == chosen_tech]
-    if chosen_plan is not None:
-        df_sub = df_sub[df_sub["tipo_plan"] == chosen_plan]
-
-    df_sub = (
-        df_sub.groupby(["sitio", "longitud", "latitud"])
-        .agg({"sum_bytes": "sum"})
-        .reset_index()
+def update_graph(
+    startDate,
+    endDate,
+    selectedLocation,
+    chosen_tech,
+    chosen_plan,
+    relayoutData,
+    version,
+    geometria_actual,
+):
+    if not estado["listo"]:
+        return figura_cargando(), None
+
+    # Zoom de la vista: el de la ubicacion elegida o el ultimo del usuario
+    lat, lon, zoom = centro_mapa(selectedLocation)
+    disparadores = [t["prop_id"] for t in dash.callback_context.triggered]
+    # Al elegir una ubicacion, la vista anterior del usuario ya no aplica
+    vista = None
+    if relayoutData and "location-dropdown.value" not in disparadores:
+        zoom = relayoutData.get("mapbox.zoom", zoom)
+        if "mapbox.center" in relayoutData:
+            lat = relayoutData["mapbox.center"]["lat"]
+            lon = relayoutData["mapbox.center"]["lon"]
+        if "mapbox._derived" in relayoutData:
+            vista = caja_derivada(relayoutData["mapbox._derived"]["coordinates"])
+    if vista is None:
+        vista = caja_vista(lat, lon, zoom)
+    nivel = estado["rejilla"].nivel(zoom)
+
+    # Solo se envian los sitios dentro de la vista mas un margen; mientras
+    # la vista no se salga de esa caja se conserva
+    nivel_actual = geometria_actual["nivel"] if geometria_actual else None
+    caja_actual = geometria_actual["caja"] if geometria_actual else None
+    misma_caja = nivel == nivel_actual and caja_actual and contiene(caja_actual, vista)
+    # Un zoom o desplazamiento que no cambia de nivel ni de caja no cambia la figura
+    if disparadores == ["map-graph.relayoutData"] and misma_caja:
+        raise PreventUpdate
+    caja = tuple(caja_actual) if misma_caja else ampliar(vista)
+
+    # Consumo desde el cache compartido: con un acierto no se consulta al
+    # backend, ni para decidir entre Patch y figura completa
+    df_sub, puntos = consumo_mapa(startDate, endDate, chosen_tech, chosen_plan, nivel, caja)
+    geometria = {
+        "version": str(estado["version"]),
+        "nivel": nivel,
+        "ubicacion": selectedLocation,
+        "caja": list(caja),
+        "puntos": puntos,
+    }
+    if Patch is not None and geometria == geometria_actual:
+        # Mismos puntos en el mismo lugar: solo cambia el color (y con el
+        # los bytes del hover); coordenadas, colorscale y layout se quedan
+        # como estan en el navegador
+        fig = Patch()
+        fig["data"][0]["marker"]["color"] = arreglo(df_sub["sum_bytes"], "f8")
+        return fig, geometria
+    # Las celdas ya consultadas se reusan para la figura; no son parte de
+    # la llave del cache (la determinan las entradas, el nivel y la caja)
+    figura = figura_mapa(
+        startDate, endDate, selectedLocation, chosen_tech, chosen_plan, nivel, caja, df_sub
     )
+    return figura, geometria
 
-    latInitial = 25.6823
-    lonInitial = -100.3030
-    zoom = 10.0
 
+def centro_mapa(selectedLocation):
+    # (lat, lon, zoom) iniciales del mapa, o los de la ubicacion elegida
     if selectedLocation:
-        zoom = 15.0
-        latInitial = list_of_locations[selectedLocation]["lat"]
-        lonInitial = list_of_locations[selectedLocation]["lon"]
+        ubicacion = list_of_locations[selectedLocation]
+        return ubicacion["lat"], ubicacion["lon"], 15.0
+    return 25.6823, -100.3030, 10.0
+
+
+@memo.memoizar(
+    lambda inicio, fin, tech, plan, nivel, caja: [
+        llave_fecha(inicio),
+        llave_fecha(fin),
+        llave_filtro(tech),
+        llave_filtro(plan),
+        nivel,
+        caja,
+    ]
+)
+def consumo_mapa(startDate, endDate, chosen_tech, chosen_plan, nivel, caja):
+    # Consumo por sitio en el rango, solo para los sitios dentro de la caja
+    # (todos si no hay caja), agrupado en celdas de acuerdo al nivel de
+    # zoom; regresa las celdas y la huella de los sitios con datos
+    indices = None if caja is None else estado["indice"].en_caja(*caja)
+    total, hay = estado["consulta"].por_sitio(
+        startDate, endDate, chosen_tech, chosen_plan, indices
+    )
+    return estado["rejilla"].agregar(nivel, total, hay, indices), estado["rejilla"].huella(hay)
+
+
+@memo.memoizar(
+    lambda inicio, fin, ubicacion, tech, plan, nivel, caja=None, celdas=None: [
+        llave_fecha(inicio),
+        llave_fecha(fin),
+        ubicacion,
+        llave_filtro(tech),
+        llave_filtro(plan),
+        nivel,
+        caja,
+    ]
+)
+def figura_mapa(
+    startDate, endDate, selectedLocation, chosen_tech, chosen_plan, nivel, caja=None, celdas=None
+):
+    # celdas: las de consumo_mapa si quien llama ya las tiene
+    df_sub = celdas
+    if df_sub is None:
+        df_sub, _ = consumo_mapa(startDate, endDate, chosen_tech, chosen_plan, nivel, caja)
+
+    latInitial, lonInitial, zoom = centro_mapa(selectedLocation)
 
     # Create figure
-    return go.Figure(
+    fig = go.Figure(
         data=[
             go.Scattermapbox(
                 lon=df_sub["longitud"],
@@ -458,7 +870,8 @@ def update_graph(datePicked, selectedLocation, chosen_tech, chosen_plan):
                     showscale=True,
                     color=df_sub["sum_bytes"],
                     opacity=0.5,
-                    size=5,
+                    # Las celdas crecen con el numero de sitios que agrupan
+                    size=np.clip(5 + 2 * np.sqrt(df_sub["n_sitios"] - 1), 5, 25),
                     colorscale=[
                         [0, "#F4EC15"],
                         [0.04167, "#DAF017"],
@@ -487,12 +900,14 @@ def update_graph(datePicked, selectedLocation, chosen_tech, chosen_plan):
                         thicknessmode="pixels",
                     ),
                 ),
-                hovertext= [
-                                "Sitio: {} <br> Lat: {} <br> Lon: {} <br> Consumo Bytes: {}".format(i,j,k,humanize.naturalsize(l))
-	                            #for i,j,k,l in zip(df["sitio"], df["latitud"],df["longitud"], df["sum_bytes"])
-                                for i,j,k,l in zip(df["sitio"], df["latitud"],df["longitud"],df_sub["sum_bytes"] )
-                            ],
-		        mode="markers+text",
+                # Etiqueta por punto; el navegador da formato a los bytes
+                # (el color del marcador) con el hovertemplate
+                customdata=df_sub["etiqueta"],
+                hovertemplate=(
+                    "%{customdata} <br> Lat: %{lat} <br> Lon: %{lon} <br> "
+                    "Consumo Bytes: %{marker.color:.3s}B<extra></extra>"
+                ),
+                mode="markers+text",
             ),
             # Plot important locations on the map
             go.Scattermapbox(
@@ -506,7 +921,9 @@ def update_graph(datePicked, selectedLocation, chosen_tech, chosen_plan):
         ],
         layout=go.Layout(
             margin={"r": 0, "t": 0, "l": 0, "b": 0},
-            uirevision="foo",
+            # La vista del usuario se conserva entre figuras hasta que elige
+            # otra ubicacion; entonces se centra en ella
+            uirevision=selectedLocation or "mapa",
             clickmode="event+select",
             hovermode="closest",
             hoverdistance=2,
@@ -520,6 +937,280 @@ def update_graph(datePicked, selectedLocation, chosen_tech, chosen_plan):
             ),
         ),
     )
+    # Coordenadas en float32; bytes en float64 (plotly.js no tiene int64)
+    return empacar(
+        fig,
+        {
+            (0, "lat"): "f4",
+            (0, "lon"): "f4",
+            (0, "marker.color"): "f8",
+            (0, "marker.size"): "f4",
+        },
+    )
+
+
+if MODO_CLIENTE:
+    # El cubo se envia una vez por sesion; el histograma y el color del
+    # mapa se recalculan en el navegador (assets/clientside.js)
+    @app.callback(Output("cubo-cliente", "data"), [Input("version-datos", "data")])
+    def enviar_cubo(version):
+        if not estado["listo"]:
+            raise PreventUpdate
+        [xVal, yVal, colorVal] = get_selection(None, None, None, None)
+        datos_cliente = estado["diario"].para_cliente(estado["cubo"])
+        datos_cliente["version"] = str(estado["version"])
+        # Plantilla del histograma; el navegador llena barras y etiquetas
+        datos_cliente["histograma"] = figura_histograma(xVal, yVal * 0, colorVal)
+        return datos_cliente
+
+    # Geometria del mapa (un punto por sitio); solo cambia con la ubicacion
+    @app.callback(
+        Output("mapa-base", "data"),
+        [Input("location-dropdown", "value"), Input("version-datos", "data")],
+    )
+    def mapa_base(selectedLocation, version):
+        if not estado["listo"]:
+            raise PreventUpdate
+        return figura_mapa(None, None, selectedLocation, None, None, ZOOM_SITIOS)
+
+    app.clientside_callback(
+        ClientsideFunction("telefonica", "histograma"),
+        Output("histogram", "figure"),
+        [
+            Input("date-picker", "start_date"),
+            Input("date-picker", "end_date"),
+            Input("tech_name", "value"),
+            Input("tipo_plan", "value"),
+            Input("cubo-cliente", "data"),
+        ],
+    )
+    app.clientside_callback(
+        ClientsideFunction("telefonica", "mapa"),
+        Output("map-graph", "figure"),
+        [
+            Input("date-picker", "start_date"),
+            Input("date-picker", "end_date"),
+            Input("tech_name", "value"),
+            Input("tipo_plan", "value"),
+            Input("cubo-cliente", "data"),
+            Input("mapa-base", "data"),
+        ],
+    )
+else:
+    app.callback(
+        Output("histogram", "figure"),
+        [
+            Input("date-picker", "start_date"),
+            Input("date-picker", "end_date"),
+            Input("tech_name", "value"),
+            Input("tipo_plan", "value"),
+            Input("version-datos", "data"),
+        ],
+    )(update_histogram)
+    app.callback(
+        [Output("map-graph", "figure"), Output("geometria-mapa", "data")],
+        [
+            Input("date-picker", "start_date"),
+            Input("date-picker", "end_date"),
+            Input("location-dropdown", "value"),
+            Input("tech_name", "value"),
+            Input("tipo_plan", "value"),
+            Input("map-graph", "relayoutData"),
+            Input("version-datos", "data"),
+        ],
+        [State("geometria-mapa", "data")],
+    )(update_graph)
+
+
+# Output del panel de consumo alrededor de la ubicacion
+@app.callback(
+    Output("radio-graph", "figure"),
+    [
+        Input("location-dropdown", "value"),
+        Input("radio-km", "value"),
+        Input("tipo_plan", "value"),
+        Input("version-datos", "data"),
+    ],
+)
+@memo.memoizar(lambda ubicacion, km, plan, version: [ubicacion, km, llave_filtro(plan)])
+def update_radio(selectedLocation, km, chosen_plan, version):
+    if not estado["listo"]:
+        return figura_cargando()
+    if not selectedLocation:
+        return figura_mensaje("Seleccione una ubicación para ver el consumo a su alrededor")
+    cubo = estado["cubo"]
+
+    # Sitios a km o menos de la ubicacion, desde el indice espacial, y su
+    # consumo por semana y tecnologia desde el cubo
+    ubicacion = list_of_locations[selectedLocation]
+    indices = estado["indice"].en_radio(ubicacion["lat"], ubicacion["lon"], km)
+    consumo = cubo.por_semana_tecnologia(chosen_plan, indices)
+    semanas = np.datetime_as_string(cubo.semanas, unit="D")
+
+    fig = go.Figure(
+        data=[
+            go.Bar(
+                name=str(tecnologia),
+                x=semanas,
+                y=consumo[:, i],
+                hovertemplate="%{x}<br>%{y:.3s}B<extra>" + str(tecnologia) + "</extra>",
+            )
+            for i, tecnologia in enumerate(cubo.tecnologias)
+        ],
+        layout=go.Layout(
+            title=dict(
+                text="{} a {} km: {} sitios, {}".format(
+                    selectedLocation,
+                    km,
+                    len(indices),
+                    humanize.naturalsize(int(consumo.sum())),
+                ),
+                font=dict(size=14),
+            ),
+            barmode="stack",
+            margin=go.layout.Margin(l=40, r=0, t=40, b=40),
+            plot_bgcolor="#323130",
+            paper_bgcolor="#323130",
+            font=dict(color="white"),
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+        ),
+    )
+    return empacar(fig, {(i, "y"): "f8" for i in range(len(cubo.tecnologias))})
+
+
+# Output de la capa de Voronoi
+@app.callback(
+    [Output("voronoi-graph", "figure"), Output("geometria-voronoi", "data")],
+    [
+        Input("fecha_voronoi", "start_date"),
+        Input("fecha_voronoi", "end_date"),
+        Input("tech_voronoi", "value"),
+        Input("plan_voronoi", "value"),
+        Input("version-datos", "data"),
+    ],
+    [State("geometria-voronoi", "data")],
+)
+def update_voronoi(startDate, endDate, chosen_tech, chosen_plan, version, geometria_actual):
+    if not estado["listo"]:
+        return figura_cargando(), None
+    teselacion = estado["teselacion"]
+    if teselacion is None:
+        return figura_mensaje("Capa de Voronoi no disponible (requiere scipy)"), None
+
+    # Consumo por poligono desde el cubo; la teselacion no se recalcula
+    total, _ = estado["consulta"].por_sitio(startDate, endDate, chosen_tech, chosen_plan)
+    z = teselacion.por_poligono(total)
+    geometria = str(estado["version"])
+    if Patch is not None and geometria == geometria_actual:
+        # El navegador ya tiene los poligonos: solo cambian los colores
+        fig = Patch()
+        fig["data"][0]["z"] = arreglo(z, "f8")
+        return fig, geometria
+
+    lat, lon, zoom = centro_mapa(None)
+    fig = go.Figure(
+        data=[
+            go.Choroplethmapbox(
+                locations=list(range(len(z))),
+                z=z,
+                text=teselacion.etiquetas,
+                colorscale=[[0, "#F4EC15"], [0.5, "#29C481"], [1.0, "#613099"]],
+                marker=dict(opacity=0.6, line=dict(width=0.5, color="#343332")),
+                colorbar=dict(
+                    title="Consumo<br>Datos",
+                    tickfont=dict(color="#d8d8d8"),
+                    titlefont=dict(color="#d8d8d8"),
+                ),
+                hovertemplate="%{text}<br>Consumo Bytes: %{z:.3s}B<extra></extra>",
+            )
+        ],
+        layout=go.Layout(
+            margin={"r": 0, "t": 0, "l": 0, "b": 0},
+            uirevision="voronoi",
+            paper_bgcolor="#323130",
+            mapbox=dict(
+                accesstoken=mapbox_access_token,
+                style="dark",
+                center={"lat": lat, "lon": lon},
+                zoom=zoom,
+            ),
+        ),
+    )
+    figura = empacar(fig, {(0, "z"): "f8"})
+    # Los poligonos se agregan al final, ya como diccionario, para no
+    # copiarlos ni validarlos en cada llamada
+    figura["data"][0]["geojson"] = teselacion.geojson
+    return figura, geometria
+
+
+# Output del mapa de calor por hora
+@app.callback(
+    Output("heatmap", "figure"),
+    [
+        Input("tech_horas", "value"),
+        Input("plan_horas", "value"),
+        Input("sitio_horas", "value"),
+        Input("version-datos", "data"),
+    ],
+)
+@memo.memoizar(
+    lambda tech, plan, sitios_sel, version: [
+        llave_filtro(tech),
+        llave_filtro(plan),
+        sorted(sitios_sel or []),
+    ]
+)
+def update_heatmap(chosen_tech, chosen_plan, chosen_sites, version):
+    if not estado["listo"]:
+        return figura_cargando()
+    horario = estado["horario"]
+
+    # Matriz (dia, hora): reduccion del cubo horario o consulta a DuckDB
+    z = horario.por_dia_hora(chosen_tech, chosen_plan, chosen_sites)
+
+    fig = go.Figure(
+        data=[
+            go.Heatmap(
+                x=np.datetime_as_string(horario.dias, unit="D"),
+                y=list(range(24)),
+                z=z.T,
+                colorscale=[[0, "#F4EC15"], [0.5, "#29C481"], [1.0, "#613099"]],
+                colorbar=dict(
+                    title="Consumo<br>Datos",
+                    tickfont=dict(color="#d8d8d8"),
+                    titlefont=dict(color="#d8d8d8"),
+                ),
+                hovertemplate="%{x}<br>%{y}:00 h<br>%{z:.3s}B<extra></extra>",
+            )
+        ],
+        layout=go.Layout(
+            margin=go.layout.Margin(l=40, r=0, t=20, b=40),
+            plot_bgcolor="#323130",
+            paper_bgcolor="#323130",
+            font=dict(color="white"),
+            xaxis=dict(showgrid=False),
+            yaxis=dict(title="Hora", showgrid=False, dtick=2),
+        ),
+    )
+    return empacar(fig, {(0, "z"): "f8"})
+
+
+def crear_app(en_hilo=False):
+    # Carga los datos y regresa la app. en_hilo=False (WSGI): la carga
+    # termina antes de regresar, asi con "gunicorn --preload" ocurre una
+    # sola vez en el proceso maestro y los workers heredan los cubos
+    # (mapeados desde cache/) sin copiarlos
+    if en_hilo:
+        threading.Thread(target=cargar_datos, name="carga-datos", daemon=True).start()
+    else:
+        cargar_datos()
+    return app
 
 
-app.run_server(debug=True)
+if __name__ == "__main__":
+    # Servidor de desarrollo. El reloader de debug corre el script en un
+    # proceso hijo (WERKZEUG_RUN_MAIN); solo ese carga los datos
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        crear_app(en_hilo=True)
+    app.run_server(debug=True)
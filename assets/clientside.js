@@ -0,0 +1,147 @@
+/* Callbacks del lado del cliente (TELEFONICA_MODO_CLIENTE=1) ------------ */
+/* Reciben el cubo compacto (celdas con datos de cada dia) una vez por      */
+/* sesion y recalculan histograma y colores del mapa localmente.            */
+
+(function () {
+  var decodificados = {};
+
+  function decodificar(b64, Tipo) {
+    var binario = atob(b64);
+    var bytes = new Uint8Array(binario.length);
+    for (var i = 0; i < binario.length; i++) {
+      bytes[i] = binario.charCodeAt(i);
+    }
+    return new Tipo(bytes.buffer);
+  }
+
+  // Arreglos del cubo, decodificados una sola vez por version de datos
+  function arreglos(cubo) {
+    if (!decodificados[cubo.version]) {
+      decodificados = {};
+      decodificados[cubo.version] = {
+        celdas: decodificar(cubo.celdas, Uint32Array),
+        bytes: decodificar(cubo.bytes, Float64Array),
+      };
+    }
+    return decodificados[cubo.version];
+  }
+
+  // Mismo formato que humanize.naturalsize (unidades decimales)
+  function tamano(valor) {
+    var unidades = ["kB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"];
+    if (valor === 1) {
+      return "1 Byte";
+    }
+    if (valor < 1000) {
+      return valor + " Bytes";
+    }
+    var i = 0;
+    var base = 1000;
+    while (i < unidades.length - 1 && valor >= base * 1000) {
+      base *= 1000;
+      i++;
+    }
+    return (valor / base).toFixed(1) + " " + unidades[i];
+  }
+
+  // Un filtro vacio (null o []) deja pasar todo; uno multiple es una lista
+  function elegido(filtro, valor) {
+    if (filtro == null || (Array.isArray(filtro) && filtro.length === 0)) {
+      return true;
+    }
+    return Array.isArray(filtro) ? filtro.indexOf(valor) >= 0 : filtro === valor;
+  }
+
+  // Consumo por semana y por sitio en el rango de fechas, con los filtros
+  function reducir(cubo, inicio, fin, tecnologia, plan) {
+    var D = cubo.forma[0], T = cubo.forma[1], P = cubo.forma[2], S = cubo.forma[3];
+    var a = arreglos(cubo);
+    var desde = inicio ? inicio.slice(0, 10) : null;
+    var hasta = fin ? fin.slice(0, 10) : null;
+    var porSemana = new Float64Array(cubo.semanas.length);
+    var porSitio = new Float64Array(S);
+    var hay = new Uint8Array(S);
+
+    // Combinaciones (tecnologia, plan) elegidas, una sola vez
+    var tp = new Uint8Array(T * P);
+    for (var t = 0; t < T; t++) {
+      for (var p = 0; p < P; p++) {
+        tp[t * P + p] = elegido(tecnologia, cubo.tecnologias[t]) && elegido(plan, cubo.planes[p]);
+      }
+    }
+
+    for (var d = 0; d < D; d++) {
+      // Fechas ISO: el orden de las cadenas es el de las fechas
+      if ((desde !== null && cubo.dias[d] < desde) || (hasta !== null && cubo.dias[d] > hasta)) {
+        continue;
+      }
+      var w = cubo.semana_de_dia[d];
+      // Solo las celdas con datos del dia; posicion = (t * P + p) * S + s
+      for (var k = cubo.inicio[d]; k < cubo.inicio[d + 1]; k++) {
+        var celda = a.celdas[k];
+        if (!tp[Math.floor(celda / S)]) {
+          continue;
+        }
+        var s = celda % S;
+        var v = a.bytes[k];
+        porSemana[w] += v;
+        porSitio[s] += v;
+        hay[s] = 1;
+      }
+    }
+    return { porSemana: porSemana, porSitio: porSitio, hay: hay };
+  }
+
+  window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    telefonica: {
+      histograma: function (inicio, fin, tecnologia, plan, cubo) {
+        if (!cubo) {
+          return window.dash_clientside.no_update;
+        }
+        var y = Array.from(reducir(cubo, inicio, fin, tecnologia, plan).porSemana);
+        var maximo = Math.max.apply(null, y);
+        var fig = JSON.parse(JSON.stringify(cubo.histograma));
+        fig.data[0].y = y;
+        fig.data[1].y = y.map(function (v) { return v / 2; });
+        fig.layout.yaxis.range = [0, maximo + maximo / 4];
+        fig.layout.annotations = y.map(function (v, i) {
+          return {
+            x: i,
+            y: v,
+            text: tamano(v),
+            xanchor: "center",
+            yanchor: "bottom",
+            showarrow: false,
+            font: { color: "white" },
+          };
+        });
+        return fig;
+      },
+
+      mapa: function (inicio, fin, tecnologia, plan, cubo, base) {
+        if (!cubo || !base) {
+          return window.dash_clientside.no_update;
+        }
+        var r = reducir(cubo, inicio, fin, tecnologia, plan);
+        var lat = [], lon = [], color = [], customdata = [];
+        for (var s = 0; s < r.hay.length; s++) {
+          if (r.hay[s]) {
+            lat.push(cubo.latitud[s]);
+            lon.push(cubo.longitud[s]);
+            color.push(r.porSitio[s]);
+            customdata.push("Sitio: " + cubo.sitios[s]);
+          }
+        }
+        // Solo cambian los puntos de la primera traza; layout y la traza
+        // de ubicaciones se reutilizan tal cual
+        var traza = Object.assign({}, base.data[0], {
+          lat: lat,
+          lon: lon,
+          customdata: customdata,
+        });
+        traza.marker = Object.assign({}, base.data[0].marker, { color: color, size: 5 });
+        return { data: [traza].concat(base.data.slice(1)), layout: base.layout };
+      },
+    },
+  });
+})();
@@ -0,0 +1,317 @@
+# Benchmark de punta a punta
+# Genera un CSV sintetico (o usa uno dado), mide cada etapa del pipeline y
+# la latencia de los callbacks a traves del servidor Flask de la app, y
+# escribe los resultados en JSON para compararlos entre commits.
+# La memoria pico por etapa es la de tracemalloc (incluye los arreglos de
+# numpy/pandas, no los procesos hijos); rss_max_mb es el maximo del proceso.
+# Uso: python benchmark.py --filas 1000000 --sitios 2000 --salida bench.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+DIR_REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIR_REPO)
+
+import datos  # noqa: E402
+import generar_datos  # noqa: E402
+import sankey  # noqa: E402
+from cubo import Cubo, CuboDiario, CuboHorario  # noqa: E402
+from metricas import etapas  # noqa: E402
+from voronoi import Voronoi, teselar  # noqa: E402
+
+
+def rss_max_mb():
+    # ru_maxrss esta en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Medidor:
+    def __init__(self):
+        self.etapas = {}
+        tracemalloc.start()
+
+    def medir(self, nombre, funcion, *args, filas=None):
+        # Tiempo y memoria pico de una etapa; filas(resultado) da cuantas
+        # filas produjo, si aplica
+        tracemalloc.reset_peak()
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        segundos = time.perf_counter() - inicio
+        pico = tracemalloc.get_traced_memory()[1]
+        etapa = {
+            "segundos": round(segundos, 4),
+            "pico_mb": round(pico / 2 ** 20, 1),
+            "rss_max_mb": rss_max_mb(),
+        }
+        if filas is not None:
+            etapa["filas"] = int(filas(resultado))
+        self.etapas[nombre] = etapa
+        print("  {:<16} {:9.3f} s {:9.1f} MB".format(nombre, segundos, etapa["pico_mb"]))
+        return resultado
+
+
+def llamar(cliente, salidas, entradas, estado=()):
+    # Una llamada a un callback como la haria el navegador; regresa
+    # (milisegundos, respuesta en JSON, bytes)
+    def propiedad(texto, valor=None):
+        id, prop = texto.split(".")
+        return {"id": id, "property": prop, "value": valor}
+
+    cuerpo = {
+        "output": salidas[0] if len(salidas) == 1 else "..{}..".format("...".join(salidas)),
+        "outputs": [
+            {"id": s.split(".")[0], "property": s.split(".")[1]} for s in salidas
+        ],
+        "inputs": [propiedad(k, v) for k, v in entradas],
+        "state": [propiedad(k, v) for k, v in estado],
+        "changedPropIds": [entradas[0][0]],
+    }
+    if len(salidas) == 1:
+        cuerpo["outputs"] = cuerpo["outputs"][0]
+    inicio = time.perf_counter()
+    respuesta = cliente.post("/_dash-update-component", json=cuerpo)
+    ms = (time.perf_counter() - inicio) * 1000
+    if respuesta.status_code not in (200, 204):
+        raise RuntimeError("{}: {}".format(salidas, respuesta.status_code))
+    datos_respuesta = respuesta.get_data()
+    contenido = json.loads(datos_respuesta)["response"] if respuesta.status_code == 200 else {}
+    return ms, contenido, len(datos_respuesta)
+
+
+def resumen(tiempos, tamanos):
+    return {
+        "llamadas": len(tiempos),
+        "mediana_ms": round(float(np.median(tiempos)), 3),
+        "p95_ms": round(float(np.percentile(tiempos, 95)), 3),
+        "bytes_promedio": int(np.mean(tamanos)),
+    }
+
+
+def casos(estado):
+    # Combinaciones de filtros: sin filtro, una semana, y tecnologias/planes
+    semana = (
+        estado["fecha_min"].strftime("%Y-%m-%d"),
+        (estado["fecha_min"] + pd.Timedelta(days=6)).strftime("%Y-%m-%d"),
+    )
+    tecnologias = [str(t) for t in estado["cubo"].tecnologias]
+    planes = [str(p) for p in estado["cubo"].planes]
+    return [
+        ((None, None), None, None),
+        (semana, None, None),
+        (semana, tecnologias[-1:], None),
+        ((None, None), tecnologias[:2], planes[:1]),
+    ]
+
+
+def medir_callbacks(app, repeticiones):
+    estado = app.estado
+    cliente = app.app.server.test_client()
+    resultados = {}
+
+    def histograma(fechas, tecnologia, plan):
+        return llamar(
+            cliente,
+            ["histogram.figure"],
+            [
+                ("date-picker.start_date", fechas[0]),
+                ("date-picker.end_date", fechas[1]),
+                ("tech_name.value", tecnologia),
+                ("tipo_plan.value", plan),
+                ("version-datos.data", 1),
+            ],
+        )
+
+    def mapa(fechas, tecnologia, plan, geometria=None):
+        return llamar(
+            cliente,
+            ["map-graph.figure", "geometria-mapa.data"],
+            [
+                ("date-picker.start_date", fechas[0]),
+                ("date-picker.end_date", fechas[1]),
+                ("location-dropdown.value", None),
+                ("tech_name.value", tecnologia),
+                ("tipo_plan.value", plan),
+                ("map-graph.relayoutData", None),
+                ("version-datos.data", 1),
+            ],
+            [("geometria-mapa.data", geometria)],
+        )
+
+    def heatmap(fechas, tecnologia, plan):
+        return llamar(
+            cliente,
+            ["heatmap.figure"],
+            [
+                ("tech_horas.value", tecnologia),
+                ("plan_horas.value", plan),
+                ("sitio_horas.value", None),
+                ("version-datos.data", 1),
+            ],
+        )
+
+    callbacks = {"update_histogram": histograma, "update_graph": mapa, "update_heatmap": heatmap}
+    version = app.memo.version
+    for modo in ("sin_cache", "con_cache"):
+        # sin_cache: se calcula cada vez; con_cache: aciertos del cache
+        app.memo.version = (lambda: None) if modo == "sin_cache" else version
+        for nombre, funcion in callbacks.items():
+            tiempos, tamanos = [], []
+            for caso in casos(estado):
+                if modo == "con_cache":
+                    funcion(*caso)
+                for _ in range(repeticiones):
+                    ms, _, n = funcion(*caso)
+                    tiempos.append(ms)
+                    tamanos.append(n)
+            resultados["{}.{}".format(nombre, modo)] = resumen(tiempos, tamanos)
+
+    # Cambio de fecha con los mismos puntos en el mapa: actualizacion parcial
+    _, contenido, _ = mapa((None, None), None, None)
+    geometria = contenido["geometria-mapa"]["data"]
+    tiempos, tamanos = [], []
+    for caso in casos(estado)[:2] * repeticiones:
+        ms, _, n = mapa(caso[0], None, None, geometria)
+        tiempos.append(ms)
+        tamanos.append(n)
+    resultados["update_graph.patch"] = resumen(tiempos, tamanos)
+    app.memo.version = version
+
+    for nombre, r in resultados.items():
+        print(
+            "  {:<28} {:8.2f} ms (p95 {:8.2f}) {:9d} bytes".format(
+                nombre, r["mediana_ms"], r["p95_ms"], r["bytes_promedio"]
+            )
+        )
+    return resultados
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=DIR_REPO, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def correr(args):
+    medidor = Medidor()
+    directorio = args.dir or tempfile.mkdtemp(prefix="telefonica_bench_")
+    os.makedirs(directorio, exist_ok=True)
+    csv = os.path.join(directorio, datos.RUTA_CSV)
+
+    print("Datos")
+    if args.csv:
+        shutil.copyfile(args.csv, csv)
+    else:
+        medidor.medir(
+            "generar", generar_datos.generar, csv, args.filas, args.sitios, args.dias
+        )
+
+    # La app usa rutas relativas (CSV y cache/) al directorio actual
+    os.chdir(directorio)
+    shutil.rmtree(datos.DIR_CACHE, ignore_errors=True)
+
+    print("Etapas")
+    bloque = pd.read_csv(csv, dtype=datos.COLUMNAS, nrows=datos.TAMANO_BLOQUE)
+    medidor.medir("limpieza", datos.limpiar, bloque, filas=len)
+    carpeta = os.path.join(directorio, "ingesta")
+    sitios = medidor.medir(
+        "ingesta",
+        datos.ingerir,
+        csv,
+        carpeta,
+        filas=lambda r: etapas.resumen()["ingesta"]["filas"],
+    )
+    # Las etapas leen el dataset por archivos, como al construir los caches
+    rutas = datos.listar_dataset(carpeta)
+    primero, ultimo = datos.rango_dias(carpeta)
+    dias = pd.date_range(primero, ultimo, freq="D").to_numpy()
+
+    def partes():
+        return (pd.read_parquet(ruta) for ruta in rutas)
+
+    medidor.medir(
+        "sankey",
+        lambda: sankey.figura_sankey(
+            sankey.sumar_enlaces([sankey.enlaces_sankey(parte) for parte in partes()])
+        ),
+        filas=lambda r: 1,
+    )
+    df_master = medidor.medir("semanal", datos.agrupar_por_semana, rutas, sitios, filas=len)
+    cubo = medidor.medir("cubo", Cubo.construir, df_master, sitios)
+    medidor.medir("diario", CuboDiario.construir, partes(), cubo, dias)
+    medidor.medir("horario", CuboHorario.construir, partes(), cubo, dias)
+    if Voronoi is not None:
+        medidor.medir("voronoi", teselar, cubo.sitios, filas=lambda r: len(r["features"]))
+    del df_master, cubo
+    shutil.rmtree(carpeta)
+
+    print("Arranque de la app")
+    os.environ["TELEFONICA_BACKEND"] = args.backend
+    import TelefonicaMapa_v5 as app
+
+    medidor.medir("arranque_frio", app.cargar_datos)
+    medidor.medir("arranque_cache", app.cargar_datos)
+
+    # tracemalloc hace mas lentas las asignaciones; no se usa en las latencias
+    tracemalloc.stop()
+    print("Callbacks")
+    callbacks = medir_callbacks(app, args.repeticiones)
+
+    resultados = {
+        "commit": commit(),
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "parametros": {
+            "filas": args.filas if not args.csv else None,
+            "sitios": args.sitios if not args.csv else None,
+            "dias": args.dias if not args.csv else None,
+            "csv": args.csv,
+            "repeticiones": args.repeticiones,
+            "backend": args.backend,
+        },
+        "etapas": medidor.etapas,
+        "callbacks": callbacks,
+        "rss_max_mb": rss_max_mb(),
+    }
+    if not args.dir and not args.conservar:
+        shutil.rmtree(directorio, ignore_errors=True)
+    return resultados
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline y los callbacks")
+    parser.add_argument("--filas", type=int, default=1_000_000)
+    parser.add_argument("--sitios", type=int, default=2000)
+    parser.add_argument("--dias", type=int, default=33)
+    parser.add_argument("--csv", help="CSV existente en lugar de uno sintetico")
+    parser.add_argument("--dir", help="directorio de trabajo (por defecto uno temporal)")
+    parser.add_argument("--conservar", action="store_true", help="no borrar el directorio")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--backend", default="cubo", help="backend de consultas: cubo o duckdb")
+    parser.add_argument("--salida", default="benchmark.json")
+    args = parser.parse_args()
+    if args.csv:
+        args.csv = os.path.abspath(args.csv)
+    salida = os.path.abspath(args.salida)
+
+    resultados = correr(args)
+    with open(salida, "w") as f:
+        json.dump(resultados, f, indent=2)
+    print("Resultados en", salida)
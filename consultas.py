@@ -0,0 +1,202 @@
+# Consultas de consumo por rango de fechas para los callbacks
+# Un backend expone dias (datetime64, del primer al ultimo dia con datos),
+# por_sitio(inicio, fin, tecnologia, plan, indices=None) -> (total, hay)
+# alineados con el eje de sitios del cubo, y
+# por_semana(semanas, inicio, fin, tecnologia, plan) -> bytes por semana.
+# El backend DuckDB tambien sirve el mapa de calor por hora (por_dia_hora,
+# como CuboHorario), para no tener el cubo horario en memoria.
+# - "cubo": CuboDiario (sumas acumuladas por dia, mapeadas desde cache/);
+#   rapido, pero ocupa memoria por cada dia, tecnologia, plan y sitio.
+# - "duckdb": consulta las particiones por fecha (particiones.py) sin
+#   cargarlas; solo abre las que se cruzan con el rango, lee las semanas
+#   completas del agregado semanal y los filtros de tecnologia, plan y sitio
+#   y la proyeccion de columnas se empujan al lector de Parquet. El costo
+#   depende del rango elegido, no de toda la historia.
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import datos
+import particiones
+from cubo import codigos, seleccion
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+BACKENDS = ("cubo", "duckdb")
+
+
+def fuera_de_memoria(backend):
+    # True si las consultas van al Parquet en lugar del cubo diario
+    if backend not in BACKENDS:
+        raise ValueError("Backend desconocido: {} (opciones: {})".format(backend, BACKENDS))
+    if backend == "duckdb" and duckdb is None:
+        print("duckdb no esta instalado; se usa el cubo diario")
+        return False
+    return backend == "duckdb"
+
+
+def lista_sql(rutas):
+    # Rutas como lista de literales de SQL para read_parquet
+    return ", ".join("'{}'".format(r.replace("'", "''")) for r in rutas)
+
+
+class ConsultaDuckDB:
+    def __init__(self, sitios, dias, dir_cache=datos.DIR_CACHE):
+        # sitios: nombres en el orden del eje de sitios del cubo; dias:
+        # primer y ultimo dia con datos (de la meta de las particiones)
+        self.sitios = [str(s) for s in sitios]
+        self.dias = pd.date_range(dias[0], dias[1], freq="D").to_numpy()
+        self.dir_cache = dir_cache
+        self._local = threading.local()
+
+    def _conexion(self):
+        # Una conexion por hilo y por proceso, como el cache de callbacks
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = duckdb.connect()
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def _partes(self, inicio, fin):
+        # Las semanas completas del rango se leen del agregado semanal y
+        # solo los dias sueltos de los extremos del dataset: regresa
+        # [(tabla, primer dia, ultimo dia), ...]
+        un_dia = pd.Timedelta(days=1)
+        primero = pd.Timestamp(self.dias[0])
+        ultimo = pd.Timestamp(self.dias[-1])
+        # Mismos dias que el cubo diario: fecha >= inicio y fecha <= fin
+        if inicio is not None:
+            primero = max(primero, pd.Timestamp(inicio).ceil("D"))
+        if fin is not None:
+            ultimo = min(ultimo, pd.Timestamp(fin).floor("D"))
+        if primero > ultimo:
+            return []
+        # Lunes que cierran la primera y la ultima semana completas
+        desde = primero + 6 * un_dia
+        desde += ((7 - desde.weekday()) % 7) * un_dia
+        hasta = ultimo - ultimo.weekday() * un_dia
+        if desde > hasta:
+            return [("dataset", primero, ultimo)]
+        partes = [("semanal", desde, hasta)]
+        if primero <= desde - 7 * un_dia:
+            partes.append(("dataset", primero, desde - 7 * un_dia))
+        if hasta < ultimo:
+            partes.append(("dataset", hasta + un_dia, ultimo))
+        return partes
+
+    def _consulta(self, llave, inicio, fin, tecnologia, plan, sitios=None):
+        # Bytes y registros por llave (sitio o fecha); cada parte lee solo
+        # las particiones que se cruzan con sus dias. En el agregado semanal
+        # cada fila viene de al menos un registro.
+        selects, parametros = [], []
+        for tabla, primero, ultimo in self._partes(inicio, fin):
+            rutas = particiones.seleccionar(tabla, primero, ultimo, self.dir_cache)
+            if not rutas:
+                continue
+            donde, valores = self._filtros(primero, ultimo, tecnologia, plan, sitios)
+            selects.append(
+                "SELECT {} AS llave, sum_bytes, {} AS registros "
+                "FROM read_parquet([{}]) WHERE {}".format(
+                    llave,
+                    "registros" if tabla == "dataset" else "1",
+                    lista_sql(rutas),
+                    donde,
+                )
+            )
+            parametros.extend(valores)
+        if not selects:
+            return pd.DataFrame({"llave": [], "bytes": [], "registros": []})
+        return (
+            self._conexion()
+            .execute(
+                "SELECT llave, sum(sum_bytes)::BIGINT AS bytes, "
+                "sum(registros)::BIGINT AS registros "
+                "FROM ({}) GROUP BY llave".format(" UNION ALL ".join(selects)),
+                parametros,
+            )
+            .df()
+        )
+
+    def _filtros(self, inicio, fin, tecnologia, plan, sitios=None):
+        # Condiciones del WHERE y sus parametros; fin es inclusivo
+        condiciones, parametros = [], []
+        if inicio is not None:
+            condiciones.append("fecha >= ?")
+            parametros.append(pd.Timestamp(inicio).to_pydatetime())
+        if fin is not None:
+            condiciones.append("fecha <= ?")
+            parametros.append(pd.Timestamp(fin).to_pydatetime())
+        for columna, valor in (("tecnologia", tecnologia), ("tipo_plan", plan), ("sitio", sitios)):
+            elegidos = seleccion(valor)
+            if elegidos is not None:
+                condiciones.append("{} IN ({})".format(columna, ", ".join("?" * len(elegidos))))
+                parametros.extend(str(v) for v in elegidos)
+        return " AND ".join(condiciones) or "TRUE", parametros
+
+    def por_sitio(self, inicio, fin, tecnologia, plan, indices=None):
+        # Consumo por sitio en el rango y mascara de sitios con datos; con
+        # indices solo se leen esos sitios
+        sitios = None if indices is None else [self.sitios[i] for i in indices]
+        if sitios is not None and len(sitios) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+        resultado = self._consulta("sitio", inicio, fin, tecnologia, plan, sitios)
+        total = np.zeros(len(self.sitios), dtype=np.int64)
+        hay = np.zeros(len(self.sitios), dtype=bool)
+        posiciones = codigos(resultado["llave"].astype(str), self.sitios)
+        conocidos = posiciones >= 0
+        total[posiciones[conocidos]] = resultado["bytes"].to_numpy(dtype=np.int64)[conocidos]
+        hay[posiciones[conocidos]] = resultado["registros"].to_numpy()[conocidos] > 0
+        if indices is not None:
+            return total[indices], hay[indices]
+        return total, hay
+
+    def por_semana(self, semanas, inicio, fin, tecnologia, plan):
+        # Consumo por semana (del agregado semanal) o por dia (extremos del
+        # rango), sumado en semanas de W-mon: de martes al lunes que las
+        # etiqueta, igual que el cubo diario
+        resultado = self._consulta("fecha", inicio, fin, tecnologia, plan)
+        fechas = resultado["llave"].to_numpy(dtype="datetime64[ns]")
+        semana = np.searchsorted(semanas, fechas)
+        # Dias fuera de todas las semanas (antes, despues o en un hueco) no cuentan
+        validos = semana < len(semanas)
+        validos[validos] = fechas[validos] > semanas[semana[validos]] - np.timedelta64(7, "D")
+        bytes = np.zeros(len(semanas), dtype=np.int64)
+        np.add.at(bytes, semana[validos], resultado["bytes"].to_numpy(dtype=np.int64)[validos])
+        return bytes
+
+    def por_dia_hora(self, tecnologia, plan, sitios):
+        # Matriz (dia, hora) como CuboHorario.por_dia_hora, leyendo la columna
+        # hora de las particiones del dataset en lugar de un cubo en memoria
+        rutas = particiones.listar("dataset", self.dir_cache)
+        matriz = np.zeros((len(self.dias), 24), dtype=np.int64)
+        if not rutas:
+            return matriz
+        donde, parametros = self._filtros(None, None, tecnologia, plan, sitios)
+        resultado = (
+            self._conexion()
+            .execute(
+                "SELECT fecha, hora, sum(sum_bytes)::BIGINT AS bytes "
+                "FROM read_parquet([{}]) WHERE hora >= 0 AND hora < 24 AND {} "
+                "GROUP BY fecha, hora".format(lista_sql(rutas), donde),
+                parametros,
+            )
+            .df()
+        )
+        fechas = resultado["fecha"].to_numpy(dtype="datetime64[ns]")
+        dia = (fechas - self.dias[0]) // np.timedelta64(1, "D")
+        matriz[dia, resultado["hora"].to_numpy(dtype=np.intp)] = resultado["bytes"].to_numpy()
+        return matriz
+
+
+def cargar_consulta_duckdb(sitios, dir_cache=datos.DIR_CACHE):
+    # Backend DuckDB sobre las particiones por semana del dataset y del
+    # agregado semanal
+    meta = particiones.cargar_particiones(dir_cache)
+    return ConsultaDuckDB(sitios["sitio"], meta["dias"], dir_cache)
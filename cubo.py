@@ -0,0 +1,484 @@
+# Cubo pre-agregado de consumo por (semana, tecnologia, tipo_plan, sitio)
+# Se construye una sola vez a partir de df_master; los callbacks solo
+# recortan ejes y suman, sin volver a filtrar ni agrupar el DataFrame.
+# Los cubos se guardan como .npy en cache/ y se abren mapeados a memoria
+# (solo lectura), asi varios procesos del servidor comparten las mismas
+# paginas en lugar de tener cada uno su copia.
+# CuboHorario guarda ademas el consumo por hora del dia, por dia y por sitio.
+# CuboDiario guarda sumas acumuladas por dia: el total de cualquier rango de
+# fechas es la resta de dos renglones, sin importar lo largo del rango.
+# Los filtros de tecnologia y plan aceptan varios valores: cada eje tiene una
+# mascara precalculada por valor y una seleccion es el OR de sus mascaras.
+
+import base64
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import datos
+from metricas import etapas
+
+
+class Cubo:
+    def __init__(self, bytes, semanas, tecnologias, planes, sitios):
+        # bytes por celda
+        self.bytes = bytes
+        # Ejes del cubo
+        self.semanas = semanas
+        self.tecnologias = tecnologias
+        self.planes = planes
+        self.eje_tecnologia = Eje(self.tecnologias)
+        self.eje_plan = Eje(self.planes)
+        # Tabla de sitios alineada con el ultimo eje
+        self.sitios = sitios.drop_duplicates("sitio").reset_index(drop=True)
+
+    @classmethod
+    def construir(cls, df_master, sitios):
+        semanas = np.sort(df_master["fecha"].unique())
+        tecnologias = sorted(df_master["tecnologia"].unique())
+        planes = sorted(df_master["tipo_plan"].unique())
+        ejes_sitios = sitios["sitio"].drop_duplicates()
+
+        indices = (
+            np.searchsorted(semanas, df_master["fecha"].to_numpy()),
+            codigos(df_master["tecnologia"], tecnologias),
+            codigos(df_master["tipo_plan"], planes),
+            codigos(df_master["sitio"], ejes_sitios),
+        )
+        forma = (len(semanas), len(tecnologias), len(planes), len(ejes_sitios))
+        bytes = np.zeros(forma, dtype=np.int64)
+        np.add.at(bytes, indices, df_master["sum_bytes"].to_numpy(dtype=np.int64))
+        return cls(bytes, semanas, tecnologias, planes, sitios)
+
+    def anexar(self, nuevo, sitios):
+        # Cubo con las filas nuevas del dataset (pre-agregadas) sumadas a
+        # sus semanas; None si traen sitios, tecnologias o planes nuevos
+        parcial = datos.semanal(nuevo)
+        semanas = np.union1d(self.semanas, parcial["fecha"].unique())
+        indices = (
+            np.searchsorted(semanas, parcial["fecha"].to_numpy()),
+            codigos(parcial["tecnologia"], self.tecnologias),
+            codigos(parcial["tipo_plan"], self.planes),
+            codigos(parcial["sitio"], self.sitios["sitio"]),
+        )
+        if any((i < 0).any() for i in indices[1:]):
+            return None
+        bytes = np.zeros((len(semanas),) + self.bytes.shape[1:], dtype=np.int64)
+        bytes[np.searchsorted(semanas, self.semanas)] = self.bytes
+        # Las llaves de semanal no se repiten
+        bytes[indices] += parcial["sum_bytes"].to_numpy(dtype=np.int64)
+        return Cubo(bytes, semanas, self.tecnologias, self.planes, sitios)
+
+    def guardar(self, ruta):
+        np.save(ruta + "_bytes.tmp.npy", self.bytes)
+        os.replace(ruta + "_bytes.tmp.npy", ruta + "_bytes.npy")
+        ejes = {
+            "semanas": [str(d)[:10] for d in self.semanas],
+            "tecnologias": [str(t) for t in self.tecnologias],
+            "planes": [str(p) for p in self.planes],
+        }
+        with open(ruta + ".json", "w") as f:
+            json.dump(ejes, f)
+
+    @classmethod
+    def cargar(cls, ruta, sitios):
+        with open(ruta + ".json") as f:
+            ejes = json.load(f)
+        return cls(
+            np.load(ruta + "_bytes.npy", mmap_mode="r"),
+            np.array(ejes["semanas"], dtype="datetime64[ns]"),
+            ejes["tecnologias"],
+            ejes["planes"],
+            sitios,
+        )
+
+    def recortar(self, arreglo, tecnologia, plan):
+        # Arreglo con los ejes filtrados; un valor que no existe deja el eje
+        # vacio, igual que un filtro sin coincidencias
+        arreglo = cortar(arreglo, 1, self.eje_tecnologia.mascara(tecnologia))
+        return cortar(arreglo, 2, self.eje_plan.mascara(plan))
+
+    def por_semana_tecnologia(self, plan, indices):
+        # Consumo por (semana, tecnologia) de los sitios indicados
+        return self.recortar(self.bytes, None, plan)[..., indices].sum(axis=(2, 3))
+
+
+class Eje:
+    # Valores de un eje con una mascara booleana precalculada por valor; la
+    # ultima fila (vacia) corresponde a valores que no estan en el eje
+    def __init__(self, valores):
+        self.valores = list(valores)
+        self.posicion = {v: i for i, v in enumerate(self.valores)}
+        n = len(self.valores)
+        self.mascaras = np.vstack((np.eye(n, dtype=bool), np.zeros((1, n), dtype=bool)))
+
+    def mascara(self, valor):
+        # None si no hay filtro; si no, OR de las mascaras de los elegidos
+        elegidos = seleccion(valor)
+        if elegidos is None:
+            return None
+        filas = [self.posicion.get(v, len(self.valores)) for v in elegidos]
+        return self.mascaras[filas].any(axis=0)
+
+
+def seleccion(valor):
+    # Valores elegidos en un filtro: None o [] es sin filtro; un valor
+    # suelto (dropdown simple) cuenta como lista de uno
+    if valor is None or (isinstance(valor, (list, tuple)) and len(valor) == 0):
+        return None
+    return list(valor) if isinstance(valor, (list, tuple)) else [valor]
+
+
+def cortar(arreglo, eje, mascara):
+    # Posiciones de la mascara sobre un eje; si son contiguas basta una
+    # vista, si no se copian solo las elegidas
+    if mascara is None:
+        return arreglo
+    posiciones = np.flatnonzero(mascara)
+    if len(posiciones) == 0 or posiciones[-1] - posiciones[0] == len(posiciones) - 1:
+        inicio = posiciones[0] if len(posiciones) else 0
+        corte = slice(inicio, inicio + len(posiciones))
+        return arreglo[(slice(None),) * eje + (corte,)]
+    return arreglo.compress(mascara, axis=eje)
+
+
+def a_base64(arreglo):
+    return base64.b64encode(np.ascontiguousarray(arreglo).tobytes()).decode("ascii")
+
+
+def codigos(columna, valores):
+    # Codigo entero de cada valor de la columna dentro de valores
+    return pd.Categorical(columna, categories=valores).codes.astype(np.intp)
+
+
+def suma_horaria(df, tecnologias, planes, sitios, dias):
+    # Bytes de df por (tecnologia, tipo_plan, sitio, fecha, hora) y sus
+    # indices en un CuboHorario con esos ejes (-1 si un valor no esta)
+    df = df[(df["hora"] >= 0) & (df["hora"] < 24)]
+    suma = df.groupby(["tecnologia", "tipo_plan", "sitio", "fecha", "hora"], observed=True)[
+        "sum_bytes"
+    ].sum()
+    llaves = suma.index
+    indices = (
+        codigos(llaves.get_level_values("tecnologia"), tecnologias),
+        codigos(llaves.get_level_values("tipo_plan"), planes),
+        codigos(llaves.get_level_values("sitio").astype(str), sitios),
+        (llaves.get_level_values("fecha").to_numpy() - dias[0]) // np.timedelta64(1, "D"),
+        llaves.get_level_values("hora").to_numpy().astype(np.intp),
+    )
+    return suma, indices
+
+
+def suma_diaria(df, tecnologias, planes, sitios, dias):
+    # Bytes y registros de df por (fecha, tecnologia, tipo_plan, sitio) y sus
+    # indices en un CuboDiario con esos ejes; el dia d va en el renglon d + 1
+    suma = df.groupby(["fecha", "tecnologia", "tipo_plan", "sitio"], observed=True)[
+        ["sum_bytes", "registros"]
+    ].sum()
+    llaves = suma.index
+    indices = (
+        (llaves.get_level_values("fecha").to_numpy() - dias[0]) // np.timedelta64(1, "D") + 1,
+        codigos(llaves.get_level_values("tecnologia"), tecnologias),
+        codigos(llaves.get_level_values("tipo_plan"), planes),
+        codigos(llaves.get_level_values("sitio").astype(str), sitios),
+    )
+    return suma, indices
+
+
+class CuboHorario:
+    # Consumo por (tecnologia, tipo_plan, sitio, dia, hora)
+    def __init__(self, bytes, dias, tecnologias, planes, sitios):
+        self.bytes = bytes
+        self.dias = dias
+        self.tecnologias = tecnologias
+        self.planes = planes
+        self.sitios = sitios
+        self.eje_tecnologia = Eje(tecnologias)
+        self.eje_plan = Eje(planes)
+        self.pos_sitio = {v: i for i, v in enumerate(sitios)}
+
+    @classmethod
+    def construir(cls, partes, cubo, dias):
+        # partes: el dataset por archivos (datos.partes_dataset); dias: un dia
+        # por fecha del rango completo, aunque alguno no tenga datos. Mismos
+        # ejes de tecnologia, plan y sitio que el cubo semanal
+        tecnologias = list(cubo.tecnologias)
+        planes = list(cubo.planes)
+        sitios = [str(s) for s in cubo.sitios["sitio"]]
+        forma = (len(tecnologias), len(planes), len(sitios), len(dias), 24)
+        bytes = np.zeros(forma, dtype=np.int64)
+        for df in partes:
+            suma, indices = suma_horaria(df, tecnologias, planes, sitios, dias)
+            # Cada dia esta en un solo archivo: las llaves no se repiten
+            bytes[indices] = suma.to_numpy()
+        return cls(bytes, dias, tecnologias, planes, sitios)
+
+    def anexar(self, nuevo, dias):
+        # Cubo con las filas nuevas sumadas, sobre dias (el rango completo
+        # despues de anexar); None si traen sitios, tecnologias o planes nuevos
+        suma, indices = suma_horaria(nuevo, self.tecnologias, self.planes, self.sitios, dias)
+        if any((i < 0).any() for i in indices[:3]):
+            return None
+        desde = (self.dias[0] - dias[0]) // np.timedelta64(1, "D")
+        hasta = desde + len(self.dias)
+        bytes = np.zeros(self.bytes.shape[:3] + (len(dias), 24), dtype=np.int64)
+        bytes[:, :, :, desde:hasta] = self.bytes
+        bytes[indices] += suma.to_numpy()
+        return CuboHorario(bytes, dias, self.tecnologias, self.planes, self.sitios)
+
+    def guardar(self, ruta):
+        np.save(ruta + ".tmp.npy", self.bytes)
+        os.replace(ruta + ".tmp.npy", ruta + ".npy")
+        ejes = {
+            "dias": [str(d)[:10] for d in self.dias],
+            "tecnologias": [str(t) for t in self.tecnologias],
+            "planes": [str(p) for p in self.planes],
+            "sitios": self.sitios,
+        }
+        with open(ruta + ".json", "w") as f:
+            json.dump(ejes, f)
+
+    @classmethod
+    def cargar(cls, ruta):
+        with open(ruta + ".json") as f:
+            ejes = json.load(f)
+        dias = np.array(ejes["dias"], dtype="datetime64[ns]")
+        bytes = np.load(ruta + ".npy", mmap_mode="r")
+        return cls(bytes, dias, ejes["tecnologias"], ejes["planes"], ejes["sitios"])
+
+    def por_dia_hora(self, tecnologia, plan, sitios):
+        # Matriz (dia, hora) sumando los sitios y categorias elegidos
+        arreglo = cortar(self.bytes, 0, self.eje_tecnologia.mascara(tecnologia))
+        arreglo = cortar(arreglo, 1, self.eje_plan.mascara(plan))
+        if sitios:
+            posiciones = [self.pos_sitio[s] for s in sitios if s in self.pos_sitio]
+            arreglo = arreglo[:, :, posiciones]
+        return arreglo.sum(axis=(0, 1, 2))
+
+
+class CuboDiario:
+    # Sumas acumuladas sobre los dias de (tecnologia, tipo_plan, sitio): el
+    # renglon d tiene el total de los dias [0, d), el renglon 0 es cero
+    def __init__(self, bytes, registros, dias, tecnologias, planes, sitios):
+        self.bytes = bytes
+        self.registros = registros
+        self.dias = dias
+        self.tecnologias = tecnologias
+        self.planes = planes
+        self.sitios = sitios
+        self.eje_tecnologia = Eje(tecnologias)
+        self.eje_plan = Eje(planes)
+
+    @classmethod
+    def construir(cls, partes, cubo, dias):
+        # partes: el dataset por archivos (datos.partes_dataset). Mismos ejes
+        # de tecnologia, plan y sitio que el cubo semanal
+        sitios = [str(s) for s in cubo.sitios["sitio"]]
+        forma = (len(dias) + 1, len(cubo.tecnologias), len(cubo.planes), len(sitios))
+        bytes = np.zeros(forma, dtype=np.int64)
+        registros = np.zeros(forma, dtype=np.int64)
+        for df in partes:
+            suma, indices = suma_diaria(df, cubo.tecnologias, cubo.planes, sitios, dias)
+            # Cada dia esta en un solo archivo: las llaves no se repiten
+            bytes[indices] = suma["sum_bytes"].to_numpy()
+            registros[indices] = suma["registros"].to_numpy()
+        np.cumsum(bytes, axis=0, out=bytes)
+        np.cumsum(registros, axis=0, out=registros)
+        return cls(bytes, registros, dias, list(cubo.tecnologias), list(cubo.planes), sitios)
+
+    def anexar(self, nuevo, dias):
+        # Cubo con las filas nuevas sumadas, sobre dias (el rango completo
+        # despues de anexar): solo se recalculan las sumas acumuladas desde
+        # el primer dia del extracto. None si trae sitios, tecnologias o
+        # planes nuevos
+        suma, indices = suma_diaria(nuevo, self.tecnologias, self.planes, self.sitios, dias)
+        if any((i < 0).any() for i in indices[1:]):
+            return None
+        desde = (self.dias[0] - dias[0]) // np.timedelta64(1, "D")
+        hasta = desde + len(self.dias) + 1
+        primero = indices[0].min()
+        acumulados = []
+        for anterior, columna in ((self.bytes, "sum_bytes"), (self.registros, "registros")):
+            # Los dias que se agregan antes del rango anterior suman cero y
+            # los de despues repiten el ultimo total
+            arreglo = np.zeros((len(dias) + 1,) + anterior.shape[1:], dtype=np.int64)
+            arreglo[desde:hasta] = anterior
+            arreglo[hasta:] = anterior[-1]
+            delta = np.zeros((len(arreglo) - primero,) + anterior.shape[1:], dtype=np.int64)
+            delta[(indices[0] - primero,) + indices[1:]] = suma[columna].to_numpy()
+            arreglo[primero:] += np.cumsum(delta, axis=0)
+            acumulados.append(arreglo)
+        return CuboDiario(*acumulados, dias, self.tecnologias, self.planes, self.sitios)
+
+    def guardar(self, ruta):
+        for nombre in ("bytes", "registros"):
+            np.save(ruta + "_" + nombre + ".tmp.npy", getattr(self, nombre))
+            os.replace(ruta + "_" + nombre + ".tmp.npy", ruta + "_" + nombre + ".npy")
+        ejes = {
+            "dias": [str(d)[:10] for d in self.dias],
+            "tecnologias": [str(t) for t in self.tecnologias],
+            "planes": [str(p) for p in self.planes],
+            "sitios": self.sitios,
+        }
+        with open(ruta + ".json", "w") as f:
+            json.dump(ejes, f)
+
+    @classmethod
+    def cargar(cls, ruta):
+        with open(ruta + ".json") as f:
+            ejes = json.load(f)
+        return cls(
+            np.load(ruta + "_bytes.npy", mmap_mode="r"),
+            np.load(ruta + "_registros.npy", mmap_mode="r"),
+            np.array(ejes["dias"], dtype="datetime64[ns]"),
+            ejes["tecnologias"],
+            ejes["planes"],
+            ejes["sitios"],
+        )
+
+    def renglones(self, inicio, fin):
+        # Renglones (i, j) de las sumas acumuladas para los dias entre
+        # inicio y fin, inclusive; None en un extremo es sin limite
+        i = 0 if inicio is None else np.searchsorted(self.dias, np.datetime64(inicio, "ns"))
+        j = len(self.dias)
+        if fin is not None:
+            j = np.searchsorted(self.dias, np.datetime64(fin, "ns"), side="right")
+        return i, max(i, j)
+
+    def recortar(self, arreglo, tecnologia, plan):
+        arreglo = cortar(arreglo, 1, self.eje_tecnologia.mascara(tecnologia))
+        return cortar(arreglo, 2, self.eje_plan.mascara(plan))
+
+    def por_sitio(self, inicio, fin, tecnologia, plan, indices=None):
+        # Consumo por sitio en el rango y mascara de sitios con datos
+        i, j = self.renglones(inicio, fin)
+        bytes = self.recortar(self.bytes[[i, j]], tecnologia, plan)
+        registros = self.recortar(self.registros[[i, j]], tecnologia, plan)
+        if indices is not None:
+            bytes = bytes[..., indices]
+            registros = registros[..., indices]
+        total = (bytes[1] - bytes[0]).sum(axis=(0, 1))
+        hay = (registros[1] - registros[0]).sum(axis=(0, 1)) > 0
+        return total, hay
+
+    def por_semana(self, semanas, inicio, fin, tecnologia, plan):
+        # Consumo de cada semana dentro del rango. Las semanas de W-mon se
+        # etiquetan con el lunes que las cierra: van de martes a lunes
+        i, j = self.renglones(inicio, fin)
+        limites = np.append(semanas - np.timedelta64(6, "D"), semanas[-1] + np.timedelta64(1, "D"))
+        cortes = np.clip(np.searchsorted(self.dias, limites), i, j)
+        acumulado = self.recortar(self.bytes[cortes], tecnologia, plan).sum(axis=(1, 2, 3))
+        return np.diff(acumulado)
+
+    def para_cliente(self, cubo):
+        # Version compacta para el navegador: solo las celdas con datos de
+        # cada dia (no acumuladas), como posicion dentro de (tecnologia,
+        # plan, sitio) en uint32 y bytes en float64 (exacto hasta 2**53),
+        # en base64; inicio[d]:inicio[d + 1] son las celdas del dia d.
+        # Se recorre un dia a la vez para no armar el cubo completo.
+        posiciones, bytes, inicio = [], [], [0]
+        for d in range(len(self.dias)):
+            con_datos = np.flatnonzero(self.registros[d + 1] - self.registros[d])
+            posiciones.append(con_datos.astype("<u4"))
+            dia = (self.bytes[d + 1] - self.bytes[d]).ravel()
+            bytes.append(dia[con_datos].astype("<f8"))
+            inicio.append(inicio[-1] + len(con_datos))
+        return {
+            "dias": list(np.datetime_as_string(self.dias, unit="D")),
+            "semanas": list(np.datetime_as_string(cubo.semanas, unit="D")),
+            "semana_de_dia": np.searchsorted(cubo.semanas, self.dias).tolist(),
+            "tecnologias": [str(t) for t in self.tecnologias],
+            "planes": [str(p) for p in self.planes],
+            "sitios": self.sitios,
+            "latitud": cubo.sitios["latitud"].astype(float).tolist(),
+            "longitud": cubo.sitios["longitud"].astype(float).tolist(),
+            "forma": [len(self.dias)] + list(self.bytes.shape[1:]),
+            "inicio": inicio,
+            "celdas": a_base64(np.concatenate(posiciones)),
+            "bytes": a_base64(np.concatenate(bytes)),
+        }
+
+
+def cargar_cubo(sitios, dir_cache=datos.DIR_CACHE):
+    # Cubo semanal desde cache mientras sea tan reciente como df_master
+    ruta = datos.ruta_cache("cubo", dir_cache)
+    semanal = datos.ruta_cache("semanal.parquet", dir_cache)
+    if datos.vigente(semanal, datos.ruta_cache("dataset.json", dir_cache)) and datos.vigente(
+        ruta + "_bytes.npy", semanal
+    ):
+        return Cubo.cargar(ruta, sitios)
+    df_master = datos.cargar_semanal(sitios, dir_cache)
+    print("Construyendo cubo")
+    with etapas.medir("cubo") as etapa:
+        cubo = Cubo.construir(df_master, sitios)
+        etapa["filas"] = len(df_master)
+    cubo.guardar(ruta)
+    return cubo
+
+
+def cargar_diario(cubo, dir_cache=datos.DIR_CACHE):
+    # CuboDiario desde cache mientras sea tan reciente como el dataset
+    ruta = datos.ruta_cache("diario", dir_cache)
+    if datos.vigente(ruta + "_registros.npy", datos.ruta_cache("dataset.json", dir_cache)):
+        return CuboDiario.cargar(ruta)
+    print("Construyendo cubo diario")
+    with etapas.medir("diario") as etapa:
+        partes = datos.partes_dataset(dir_cache, etapa)
+        diario = CuboDiario.construir(partes, cubo, datos.dias_dataset(dir_cache))
+    diario.guardar(ruta)
+    return diario
+
+
+def cargar_horario(cubo, dir_cache=datos.DIR_CACHE):
+    # CuboHorario desde cache mientras sea tan reciente como el dataset
+    ruta = datos.ruta_cache("horario", dir_cache)
+    if datos.vigente(ruta + ".npy", datos.ruta_cache("dataset.json", dir_cache)):
+        return CuboHorario.cargar(ruta)
+    print("Construyendo cubo horario")
+    with etapas.medir("horario") as etapa:
+        partes = datos.partes_dataset(dir_cache, etapa)
+        horario = CuboHorario.construir(partes, cubo, datos.dias_dataset(dir_cache))
+    horario.guardar(ruta)
+    return horario
+
+
+def cubos_vigentes(sitios, dir_cache=datos.DIR_CACHE):
+    # (cubo, diario, horario) guardados y al dia con el dataset, o None;
+    # se revisa antes de anexar, porque anexar cambia la meta del dataset
+    dataset = datos.ruta_cache("dataset.json", dir_cache)
+    semanal = datos.ruta_cache("semanal.parquet", dir_cache)
+    ruta = datos.ruta_cache("cubo", dir_cache)
+    cubo = None
+    if datos.vigente(semanal, dataset) and datos.vigente(ruta + "_bytes.npy", semanal):
+        cubo = Cubo.cargar(ruta, sitios)
+    ruta = datos.ruta_cache("diario", dir_cache)
+    diario = CuboDiario.cargar(ruta) if datos.vigente(ruta + "_registros.npy", dataset) else None
+    ruta = datos.ruta_cache("horario", dir_cache)
+    horario = CuboHorario.cargar(ruta) if datos.vigente(ruta + ".npy", dataset) else None
+    return cubo, diario, horario
+
+
+def anexar_cubos(cubos, nuevo, sitios, dir_cache=datos.DIR_CACHE):
+    # Suma las filas nuevas del dataset a los cubos vigentes y los guarda
+    # despues de la meta y del agregado semanal, asi siguen vigentes. Un cubo
+    # que no se puede actualizar (ejes nuevos) queda viejo y la app lo
+    # reconstruye completo al arrancar
+    cubo, diario, horario = cubos
+    dias = datos.dias_dataset(dir_cache)
+    with etapas.medir("anexar_cubos") as etapa:
+        if cubo is not None:
+            cubo = cubo.anexar(nuevo, sitios)
+        if diario is not None:
+            diario = diario.anexar(nuevo, dias)
+        if horario is not None:
+            horario = horario.anexar(nuevo, dias)
+        etapa["filas"] = len(nuevo)
+    nombres = ("cubo", "diario", "horario")
+    for nombre, actualizado, anterior in zip(nombres, (cubo, diario, horario), cubos):
+        if actualizado is not None:
+            actualizado.guardar(datos.ruta_cache(nombre, dir_cache))
+        elif anterior is not None:
+            print("El extracto trae ejes nuevos; el", nombre, "se reconstruye al arrancar")
+    return cubo, diario, horario
@@ -0,0 +1,457 @@
+# Carga y limpieza del dataset Telefónica
+# El CSV se lee por bloques con tipos declarados; cada bloque se limpia y se
+# pre-agrega por (sitio, fecha, hora, tecnologia, tipo_plan, plan) y sus
+# filas se apartan en disco por semana. Al terminar se combina cada semana
+# por separado, asi la memoria maxima es un bloque mas la semana mas grande
+# ya agregada, sin importar cuanta historia tenga el archivo.
+# El resultado se guarda en formato columnar (Parquet) dentro de
+# cache/particiones/dataset/, un archivo por semana (ver particiones.py),
+# para no volver a leer el CSV completo en cada arranque. dataset.json
+# identifica el CSV de origen y se reescribe con cada cambio del dataset:
+# los caches derivados comparan su fecha contra la suya.
+# Uso como paso de construccion: python datos.py
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from metricas import etapas
+
+RUTA_CSV = "DataSet_Telefonica.csv"
+DIR_CACHE = "cache"
+
+# Tipos de cada columna del CSV. hora y sum_bytes admiten nulos al leer;
+# se convierten a enteros despues de eliminar las instancias con nulls.
+COLUMNAS = {
+    "sitio": "category",
+    "latitud": "float32",
+    "longitud": "float32",
+    "fecha": "category",
+    "hora": "float32",
+    "tecnologia": "category",
+    "tipo_plan": "category",
+    "plan": "category",
+    "sum_bytes": "Int64",
+}
+LLAVES = ["sitio", "fecha", "hora", "tecnologia", "tipo_plan", "plan"]
+TAMANO_BLOQUE = 1_000_000
+# Cada cuantos bloques se combinan las tablas de sitios en una sola
+BLOQUES_POR_PLIEGUE = 8
+# Cambia cuando cambia el formato de los archivos en cache
+VERSION_CACHE = 3
+
+# Planes con pocos registros, se agrupan en "Otro"
+unpopular_plans = list(
+    ("GU", "MY", "DD", "KO", "HA", "HW", "NB", "Z2", "DC", "Z7", "DH", "JQ")
+)
+unpopular_plans.extend(
+    ("HX", "HU", "J3", "KB", "FQ", "FD", "HT", "CS", "LQ", "FO", "CH", "L0")
+)
+unpopular_plans.extend(
+    ("FN", "HV", "KK", "BF", "FM", "GG", "FA", "ZR", "HM", "GO", "R2", "HO")
+)
+unpopular_plans.extend(("ZM", "Q9", "FP", "HH", "HC", "OZ", "KI", "MZ", "GH", "QG"))
+
+
+def limpiar(df):
+    # eliminar instancias con nulls (20)
+    df = df.dropna()
+    # convertir formato de fecha: string -> datetime (solo las categorias)
+    fecha = df["fecha"].cat.remove_unused_categories()
+    fecha = fecha.cat.rename_categories(
+        pd.to_datetime(fecha.cat.categories, format="%Y-%m-%d")
+    )
+    # Convertir tipos de plan
+    plan = df["plan"].cat.remove_categories(
+        [p for p in unpopular_plans if p in df["plan"].cat.categories]
+    )
+    plan = plan.cat.add_categories(["Otro"]).fillna("Otro")
+    return df.assign(
+        fecha=fecha,
+        # convertir formato de hora: float -> int
+        hora=df["hora"].astype("int8"),
+        sum_bytes=df["sum_bytes"].astype("int64"),
+        plan=plan,
+    )
+
+
+def preagregar(df):
+    # Suma de bytes y numero de registros por llave
+    return df.groupby(LLAVES, observed=True, as_index=False).agg(
+        sum_bytes=("sum_bytes", "sum"), registros=("sum_bytes", "size")
+    )
+
+
+def concatenar(partes):
+    # Concatena conservando columnas categoricas aunque cada parte
+    # tenga sus propias categorias
+    columnas = {}
+    for col in partes[0].columns:
+        if isinstance(partes[0][col].dtype, pd.CategoricalDtype):
+            columnas[col] = union_categoricals(
+                [p[col] for p in partes], sort_categories=True
+            )
+        else:
+            columnas[col] = np.concatenate([p[col].to_numpy() for p in partes])
+    return pd.DataFrame(columnas)
+
+
+def combinar(parciales):
+    df = concatenar(parciales)
+    df = df.groupby(LLAVES, observed=True, as_index=False).agg(
+        sum_bytes=("sum_bytes", "sum"), registros=("registros", "sum")
+    )
+    # groupby con observed=True no siempre respeta el orden de las categorias
+    return df.sort_values(LLAVES, ignore_index=True)
+
+
+def lunes(fechas):
+    # Lunes que cierra la semana W-mon de cada fecha (el mismo dia si es lunes)
+    return fechas + pd.to_timedelta((7 - fechas.dt.weekday) % 7, unit="D")
+
+
+def nombre_semana(lunes):
+    return "semana={}.parquet".format(lunes.strftime("%Y-%m-%d"))
+
+
+def nombre_mes(mes):
+    return "mes={}.parquet".format(mes.strftime("%Y-%m"))
+
+
+def guardar_particion(df, ruta):
+    # Ordenado por fecha para que los grupos de filas tambien se descarten
+    # por sus estadisticas de fecha
+    guardar_parquet(df.sort_values(["fecha", "sitio"], ignore_index=True), ruta)
+
+
+def listar_dataset(carpeta):
+    # Archivos del dataset en orden cronologico: los meses compactados
+    # ("mes=") son anteriores a las semanas que quedan ("semana=")
+    if not os.path.isdir(carpeta):
+        return []
+    return sorted(
+        os.path.join(carpeta, nombre)
+        for nombre in os.listdir(carpeta)
+        if nombre.endswith(".parquet") and "=" in nombre
+    )
+
+
+def leer_dataset(carpeta):
+    return concatenar([pd.read_parquet(r) for r in listar_dataset(carpeta)])
+
+
+def ingerir(ruta, carpeta, tamano_bloque=TAMANO_BLOQUE):
+    # Lee el CSV por bloques y escribe en carpeta el dataset pre-agregado,
+    # un archivo por semana; regresa la tabla de sitios. Las filas de cada
+    # bloque se apartan en carpeta/bloques/ por semana y cada semana se
+    # combina sola al final: el trabajo crece linealmente con el archivo y
+    # la memoria no pasa de un bloque mas una semana agregada.
+    inicio = time.perf_counter()
+    apartado = os.path.join(carpeta, "bloques")
+    shutil.rmtree(carpeta, ignore_errors=True)
+    os.makedirs(apartado)
+    sitios = []
+    # Tiempo y filas de la limpieza, sumados sobre todos los bloques
+    limpieza, limpias = 0.0, 0
+    bloques = pd.read_csv(ruta, dtype=COLUMNAS, chunksize=tamano_bloque)
+    for i, bloque in enumerate(bloques, start=1):
+        inicio_limpieza = time.perf_counter()
+        bloque = limpiar(bloque)
+        limpieza += time.perf_counter() - inicio_limpieza
+        limpias += len(bloque)
+        sitios.append(bloque[["sitio", "latitud", "longitud"]].drop_duplicates())
+        if len(sitios) >= BLOQUES_POR_PLIEGUE:
+            sitios = [concatenar(sitios).drop_duplicates()]
+        parcial = preagregar(bloque)
+        parcial["fecha"] = parcial["fecha"].astype("datetime64[ns]")
+        for semana, parte in parcial.groupby(lunes(parcial["fecha"])):
+            destino = os.path.join(apartado, nombre_semana(semana))
+            os.makedirs(destino, exist_ok=True)
+            parte.to_parquet(os.path.join(destino, "{:06d}.parquet".format(i)), index=False)
+        print("  bloque {}: {} filas agregadas".format(i, len(parcial)))
+
+    filas = 0
+    for nombre in sorted(os.listdir(apartado)):
+        partes = [
+            pd.read_parquet(os.path.join(apartado, nombre, b))
+            for b in sorted(os.listdir(os.path.join(apartado, nombre)))
+        ]
+        df = combinar(partes)
+        guardar_particion(df, os.path.join(carpeta, nombre))
+        filas += len(df)
+    shutil.rmtree(apartado)
+    # informacion sitio
+    sitios = concatenar(sitios).drop_duplicates()
+    sitios = sitios.sort_values("sitio").reset_index(drop=True)
+    etapas.registrar("limpieza", limpieza, limpias)
+    etapas.registrar("ingesta", time.perf_counter() - inicio, filas)
+    return sitios
+
+
+def fusionar(origen, destino):
+    # Suma los archivos semanales de origen (salida de ingerir) a los de
+    # destino y borra origen. Solo se reescriben los archivos afectados:
+    # las filas de un mes ya compactado van a su archivo "mes=", las demas
+    # al de su semana. Regresa las rutas reescritas.
+    escritas = []
+    for ruta in listar_dataset(origen):
+        nuevo = pd.read_parquet(ruta)
+        meses = nuevo["fecha"].dt.to_period("M")
+        semana = os.path.join(destino, os.path.basename(ruta))
+        grupos = {semana: np.zeros(len(nuevo), dtype=bool)}
+        for mes in meses.unique():
+            ruta_mes = os.path.join(destino, nombre_mes(mes))
+            if os.path.exists(ruta_mes):
+                grupos[ruta_mes] = (meses == mes).to_numpy()
+        grupos[semana] = ~np.logical_or.reduce(list(grupos.values()))
+        for ruta_destino, filas in grupos.items():
+            if not filas.any():
+                continue
+            partes = [nuevo[filas]]
+            if os.path.exists(ruta_destino):
+                partes.insert(0, pd.read_parquet(ruta_destino))
+            guardar_particion(combinar(partes), ruta_destino)
+            escritas.append(ruta_destino)
+    shutil.rmtree(origen)
+    return escritas
+
+
+def rango_dias(carpeta):
+    # Primer y ultimo dia con datos del dataset
+    fechas = [pd.read_parquet(r, columns=["fecha"])["fecha"] for r in listar_dataset(carpeta)]
+    return [str(min(f.min() for f in fechas))[:10], str(max(f.max() for f in fechas))[:10]]
+
+
+def semanal(df):
+    # Suma de bytes por sitio, tipo de plan, tecnologia y semana (lunes)
+    semanas = df.groupby(
+        ["sitio", "tipo_plan", "tecnologia", pd.Grouper(key="fecha", freq="W-mon")],
+        observed=True,
+    )["sum_bytes"].sum()
+    return semanas.sort_index().reset_index()
+
+
+def semanal_archivo(ruta):
+    return semanal(pd.read_parquet(ruta))
+
+
+def sumar_semanas(partes):
+    # Une agregados semanales parciales; una semana repartida entre dos
+    # archivos (en los meses compactados) se suma en una sola fila
+    df = concatenar(partes)
+    semanas = df.groupby(["sitio", "tipo_plan", "tecnologia", "fecha"], observed=True)[
+        "sum_bytes"
+    ].sum()
+    return semanas.sort_index().reset_index()
+
+
+def agrupar_por_semana(rutas, sitios, procesos=None):
+    # Agregacion semanal en paralelo, un archivo del dataset por tarea
+    procesos = min(procesos or os.cpu_count() or 1, len(rutas))
+    if procesos > 1:
+        # Sin "fork": la carga corre en un hilo del servidor y un fork con
+        # otros hilos vivos puede heredar candados tomados y bloquearse.
+        # Con "forkserver" (o "spawn") los procesos arrancan limpios y cada
+        # uno lee sus propios archivos; importan de nuevo el script
+        # principal, que debe correr su codigo bajo if __name__ == "__main__"
+        # (como la app, wsgi y benchmark).
+        metodos = multiprocessing.get_all_start_methods()
+        contexto = multiprocessing.get_context(
+            "forkserver" if "forkserver" in metodos else "spawn"
+        )
+        with ProcessPoolExecutor(procesos, mp_context=contexto) as pool:
+            partes = list(pool.map(semanal_archivo, rutas))
+    else:
+        partes = [semanal_archivo(r) for r in rutas]
+    df_master = pd.merge(sumar_semanas(partes), sitios, on="sitio", how="left")
+    return df_master.reset_index()
+
+
+def huella(ruta):
+    # Identifica una version del CSV por tamaño y fecha de modificacion
+    info = os.stat(ruta)
+    return {"ruta": os.path.abspath(ruta), "tamano": info.st_size, "mtime": info.st_mtime}
+
+
+def leer_meta(ruta_meta):
+    if not os.path.exists(ruta_meta):
+        return {}
+    with open(ruta_meta) as f:
+        return json.load(f)
+
+
+def guardar_meta(meta, ruta_meta):
+    with open(ruta_meta + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(ruta_meta + ".tmp", ruta_meta)
+
+
+def cache_vigente(meta, fuente):
+    return meta.get("version") == VERSION_CACHE and meta.get("fuente") == fuente
+
+
+def vigente(ruta, *dependencias):
+    # Un archivo derivado es valido si existe y es tan reciente como sus fuentes
+    if not os.path.exists(ruta):
+        return False
+    return all(os.path.getmtime(ruta) >= os.path.getmtime(d) for d in dependencias)
+
+
+def ruta_cache(nombre, dir_cache=DIR_CACHE):
+    return os.path.join(dir_cache, nombre)
+
+
+def guardar_parquet(df, ruta):
+    # Escribir primero a un archivo temporal para no dejar cache a medias
+    df.to_parquet(ruta + ".tmp", index=False)
+    os.replace(ruta + ".tmp", ruta)
+
+
+def unir_sitios(*tablas):
+    sitios = concatenar(tablas).drop_duplicates()
+    return sitios.sort_values("sitio").reset_index(drop=True)
+
+
+def ruta_dataset(dir_cache=DIR_CACHE):
+    # Carpeta del dataset, la tabla "dataset" de particiones.py
+    return os.path.join(dir_cache, "particiones", "dataset")
+
+
+def dataset_vigente(ruta=RUTA_CSV, dir_cache=DIR_CACHE):
+    # True si el cache del dataset corresponde al CSV actual
+    return (
+        len(listar_dataset(ruta_dataset(dir_cache))) > 0
+        and os.path.exists(ruta_cache("sitios.parquet", dir_cache))
+        and cache_vigente(leer_meta(ruta_cache("dataset.json", dir_cache)), huella(ruta))
+    )
+
+
+def cargar_dataset(ruta=RUTA_CSV, dir_cache=DIR_CACHE, forzar=False):
+    # Deja el dataset de cache al dia con el CSV y regresa la tabla de
+    # sitios; el dataset no se carga, los caches derivados lo leen un
+    # archivo a la vez (partes_dataset)
+    carpeta = ruta_dataset(dir_cache)
+    ruta_sitios = ruta_cache("sitios.parquet", dir_cache)
+    ruta_meta = ruta_cache("dataset.json", dir_cache)
+    fuente = huella(ruta)
+    meta = leer_meta(ruta_meta)
+
+    if not forzar and dataset_vigente(ruta, dir_cache):
+        print("Cargando sitios desde cache")
+        with etapas.medir("dataset_cache") as etapa:
+            sitios = pd.read_parquet(ruta_sitios)
+            etapa["filas"] = len(sitios)
+        return sitios
+
+    print("Cargando y limpiando dataset")
+    temporal = carpeta + ".tmp"
+    sitios = ingerir(ruta, temporal)
+    # Los extractos anexados antes se vuelven a incluir al reconstruir
+    anexos = [a for a in meta.get("anexos", []) if os.path.exists(a["ruta"])]
+    for anexo in anexos:
+        print("Anexando", anexo["ruta"])
+        sitios = unir_sitios(sitios, ingerir(anexo["ruta"], temporal + ".anexo"))
+        fusionar(temporal + ".anexo", temporal)
+
+    print("Guardando cache")
+    shutil.rmtree(carpeta, ignore_errors=True)
+    os.replace(temporal, carpeta)
+    guardar_parquet(sitios, ruta_sitios)
+    meta = {"version": VERSION_CACHE, "fuente": fuente, "anexos": anexos}
+    guardar_meta(dict(meta, dias=rango_dias(carpeta)), ruta_meta)
+    return sitios
+
+
+def dias_dataset(dir_cache=DIR_CACHE):
+    # Todos los dias entre el primero y el ultimo con datos
+    primero, ultimo = leer_meta(ruta_cache("dataset.json", dir_cache))["dias"]
+    return pd.date_range(primero, ultimo, freq="D").to_numpy()
+
+
+def partes_dataset(dir_cache=DIR_CACHE, etapa=None):
+    # El dataset un archivo (una semana o un mes) a la vez, para construir
+    # los caches derivados sin tenerlo completo en memoria; si se da una
+    # etapa de metricas se le suman las filas leidas
+    for ruta in listar_dataset(ruta_dataset(dir_cache)):
+        parte = pd.read_parquet(ruta)
+        if etapa is not None:
+            etapa["filas"] = (etapa["filas"] or 0) + len(parte)
+        yield parte
+
+
+def version_datos(dir_cache=DIR_CACHE):
+    # Cambia cada vez que se reescribe el agregado semanal
+    return os.path.getmtime(ruta_cache("semanal.parquet", dir_cache))
+
+
+def cargar_semanal(sitios, dir_cache=DIR_CACHE):
+    # df_master desde cache mientras sea tan reciente como el dataset
+    ruta = ruta_cache("semanal.parquet", dir_cache)
+    if vigente(ruta, ruta_cache("dataset.json", dir_cache)):
+        print("Cargando agregado semanal desde cache")
+        return pd.read_parquet(ruta)
+
+    print("Agrupando por semana")
+    with etapas.medir("semanal") as etapa:
+        df_master = agrupar_por_semana(listar_dataset(ruta_dataset(dir_cache)), sitios)
+        etapa["filas"] = len(df_master)
+    guardar_parquet(df_master, ruta)
+    return df_master
+
+
+def actualizar_semanal(df_master, nuevo, sitios):
+    # Suma las filas nuevas a df_master; solo se reagrupan las semanas
+    # que aparecen en el extracto nuevo
+    columnas = ["sitio", "tipo_plan", "tecnologia", "fecha", "sum_bytes"]
+    parcial = semanal(nuevo)
+    afectadas = df_master["fecha"].isin(parcial["fecha"].unique())
+    recalculadas = sumar_semanas([df_master.loc[afectadas, columnas], parcial[columnas]])
+    df_master = concatenar([df_master.loc[~afectadas, columnas], recalculadas])
+    df_master = df_master.sort_values(columnas[:-1], ignore_index=True)
+    df_master = pd.merge(df_master, sitios, on="sitio", how="left")
+    return df_master.reset_index()
+
+
+def anexar(ruta, sitios, df_master, dir_cache=DIR_CACHE):
+    # Incorpora un extracto nuevo al cache; solo se reescriben los archivos
+    # del dataset de las semanas (o meses compactados) que toca. Regresa la
+    # tabla de sitios, el agregado semanal y las filas nuevas pre-agregadas,
+    # o None si ya se habia anexado
+    ruta_meta = ruta_cache("dataset.json", dir_cache)
+    meta = leer_meta(ruta_meta)
+    if any(a["ruta"] == os.path.abspath(ruta) for a in meta.get("anexos", [])):
+        print("Ya se habia anexado", ruta)
+        return None
+
+    print("Anexando", ruta)
+    temporal = ruta_dataset(dir_cache) + ".anexo"
+    anteriores = sitios
+    sitios = unir_sitios(sitios, ingerir(ruta, temporal))
+    nuevo = leer_dataset(temporal)
+    fusionar(temporal, ruta_dataset(dir_cache))
+    df_master = actualizar_semanal(df_master, nuevo, sitios)
+
+    # El agregado semanal se escribe despues de la meta del dataset para
+    # seguir vigente; la tabla de sitios solo si cambio, de ella depende la
+    # teselacion de Voronoi
+    if not sitios.equals(anteriores):
+        guardar_parquet(sitios, ruta_cache("sitios.parquet", dir_cache))
+    meta["anexos"] = meta.get("anexos", []) + [huella(ruta)]
+    meta["dias"] = [
+        min(meta["dias"][0], str(nuevo["fecha"].min())[:10]),
+        max(meta["dias"][1], str(nuevo["fecha"].max())[:10]),
+    ]
+    guardar_meta(meta, ruta_meta)
+    guardar_parquet(df_master, ruta_cache("semanal.parquet", dir_cache))
+    return sitios, df_master, nuevo
+
+
+if __name__ == "__main__":
+    cargar_dataset(forzar=True)
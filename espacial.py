@@ -0,0 +1,208 @@
+# Indices espaciales sobre la tabla de sitios
+# Rejilla: agrupa los sitios en celdas cuadradas segun el nivel de zoom del
+# mapa, para que el numero de puntos enviados no crezca con el de sitios.
+# IndiceSitios: cubeta por celda fija para encontrar los sitios dentro de
+# la vista del mapa, o a cierta distancia de un punto, sin recorrer toda
+# la tabla.
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+# Desde este zoom se envia un punto por sitio
+ZOOM_SITIOS = 13
+# Tamaño del mundo en pantalla a zoom 0; en mapbox mide 512 * 2**zoom pixeles
+PIXELES_MUNDO = 512
+# Tamaño aproximado de una celda en pantalla
+PIXELES_CELDA = 48
+# Tamaño supuesto del mapa en pantalla cuando no se conocen sus limites
+PIXELES_VISTA = (1280, 960)
+# Margen alrededor de la vista, como fraccion de su tamaño; debe cubrir al
+# menos una celda de la Rejilla para que las celdas visibles esten completas
+MARGEN_VISTA = 0.5
+# Radio medio de la Tierra
+RADIO_TIERRA_KM = 6371.0088
+
+
+class Rejilla:
+    def __init__(self, sitios):
+        # sitios alineado con el eje de sitios del cubo
+        self.sitios = sitios.reset_index(drop=True)
+        self.lat = self.sitios["latitud"].to_numpy(dtype=np.float64)
+        self.lon = self.sitios["longitud"].to_numpy(dtype=np.float64)
+        # En Mercator un grado de latitud se ve 1/cos(lat) veces mas grande
+        escala = np.cos(np.radians(self.lat.mean())) if len(self.lat) else 1.0
+
+        # Celdas precalculadas para cada nivel de zoom
+        self.niveles = []
+        for zoom in range(ZOOM_SITIOS):
+            tamano = 360.0 / (PIXELES_MUNDO * 2 ** zoom) * PIXELES_CELDA
+            columnas = np.floor(self.lon / tamano).astype(np.int64)
+            filas = np.floor(self.lat / (tamano * escala)).astype(np.int64)
+            _, primero, celda = np.unique(
+                np.column_stack((columnas, filas)), axis=0, return_index=True, return_inverse=True
+            )
+            celda = celda.ravel()
+            n = np.bincount(celda)
+            self.niveles.append(
+                {
+                    "celda": celda,
+                    "n": n,
+                    "primero": primero,
+                    # Centro de la celda: promedio de sus sitios
+                    "lat": np.bincount(celda, weights=self.lat) / n,
+                    "lon": np.bincount(celda, weights=self.lon) / n,
+                }
+            )
+
+    def nivel(self, zoom):
+        return int(min(max(zoom, 0), ZOOM_SITIOS))
+
+    def huella(self, hay):
+        # Identifica el conjunto de sitios con datos; con la misma huella y
+        # el mismo nivel los puntos del mapa son los mismos y en el mismo orden
+        return hashlib.sha1(np.packbits(hay).tobytes()).hexdigest()[:16]
+
+    def agregar(self, nivel, total, hay, indices=None):
+        # Puntos a dibujar para el nivel: consumo por celda (o por sitio)
+        # a partir del consumo por sitio y la mascara de sitios con datos.
+        # indices: sitios a los que corresponden total y hay (todos si None)
+        con_datos = np.flatnonzero(hay) if indices is None else indices[hay]
+        if nivel >= ZOOM_SITIOS:
+            return pd.DataFrame(
+                {
+                    "etiqueta": np.char.add(
+                        "Sitio: ", self.sitios["sitio"].to_numpy()[con_datos].astype(str)
+                    ),
+                    "latitud": self.lat[con_datos],
+                    "longitud": self.lon[con_datos],
+                    "sum_bytes": total[hay],
+                    "n_sitios": 1,
+                }
+            )
+
+        niv = self.niveles[nivel]
+        num_celdas = len(niv["n"])
+        suma = np.zeros(num_celdas, dtype=np.int64)
+        np.add.at(suma, niv["celda"][con_datos], total[hay])
+        activas = np.bincount(niv["celda"][con_datos], minlength=num_celdas) > 0
+
+        n = niv["n"][activas]
+        nombres = self.sitios["sitio"].to_numpy().astype(str)[niv["primero"][activas]]
+        etiqueta = np.where(
+            n == 1, np.char.add("Sitio: ", nombres), np.char.add(n.astype(str), " sitios")
+        )
+        return pd.DataFrame(
+            {
+                "etiqueta": etiqueta,
+                "latitud": niv["lat"][activas],
+                "longitud": niv["lon"][activas],
+                "sum_bytes": suma[activas],
+                "n_sitios": n,
+            }
+        )
+
+
+class IndiceSitios:
+    def __init__(self, sitios, celdas_por_eje=256):
+        # Los sitios se ordenan por celda; inicio[c]:inicio[c + 1] son las
+        # posiciones (en orden) de los sitios de la celda c
+        self.lat = sitios["latitud"].to_numpy(dtype=np.float64)
+        self.lon = sitios["longitud"].to_numpy(dtype=np.float64)
+        self.sur, self.oeste = (self.lat.min(), self.lon.min()) if len(self.lat) else (0.0, 0.0)
+        alto = self.lat.max() - self.sur if len(self.lat) else 0.0
+        ancho = self.lon.max() - self.oeste if len(self.lon) else 0.0
+        self.tamano = max(alto, ancho, 1e-6) / celdas_por_eje
+        self.filas = int(alto / self.tamano) + 1
+        self.columnas = int(ancho / self.tamano) + 1
+
+        celda = self._fila(self.lat) * self.columnas + self._columna(self.lon)
+        self.orden = np.argsort(celda, kind="stable")
+        self.inicio = np.searchsorted(celda[self.orden], np.arange(self.filas * self.columnas + 1))
+
+    def _fila(self, lat):
+        return np.clip(((lat - self.sur) / self.tamano).astype(np.int64), 0, self.filas - 1)
+
+    def _columna(self, lon):
+        return np.clip(((lon - self.oeste) / self.tamano).astype(np.int64), 0, self.columnas - 1)
+
+    def en_caja(self, sur, norte, oeste, este):
+        # Indices (ordenados) de los sitios dentro de la caja
+        if len(self.lat) == 0 or norte < self.sur or este < self.oeste:
+            return np.zeros(0, dtype=np.intp)
+        f0, f1 = self._fila(np.array([sur, norte]))
+        c0, c1 = self._columna(np.array([oeste, este]))
+        # Rangos de cada fila de celdas que toca la caja
+        filas = np.arange(f0, f1 + 1) * self.columnas
+        partes = [
+            self.orden[i:j] for i, j in zip(self.inicio[filas + c0], self.inicio[filas + c1 + 1])
+        ]
+        candidatos = np.concatenate(partes) if partes else np.zeros(0, dtype=np.intp)
+        dentro = (
+            (self.lat[candidatos] >= sur)
+            & (self.lat[candidatos] <= norte)
+            & (self.lon[candidatos] >= oeste)
+            & (self.lon[candidatos] <= este)
+        )
+        return np.sort(candidatos[dentro])
+
+    def en_radio(self, lat, lon, km):
+        # Indices (ordenados) de los sitios a km o menos de (lat, lon): la
+        # caja que contiene al circulo da los candidatos y la distancia
+        # haversine decide
+        dlat = np.degrees(km / RADIO_TIERRA_KM)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        candidatos = self.en_caja(lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        distancia = haversine(lat, lon, self.lat[candidatos], self.lon[candidatos])
+        return candidatos[distancia <= km]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Distancia en km sobre la esfera
+    lat1, lon1, lat2, lon2 = (np.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(a))
+
+
+def caja_vista(lat, lon, zoom, pixeles=PIXELES_VISTA):
+    # Limites aproximados (sur, norte, oeste, este) de un mapa de pixeles
+    # centrado en (lat, lon)
+    grados = 360.0 / (PIXELES_MUNDO * 2 ** zoom)
+    medio_ancho = pixeles[0] / 2 * grados
+    medio_alto = pixeles[1] / 2 * grados * np.cos(np.radians(lat))
+    return (lat - medio_alto, lat + medio_alto, lon - medio_ancho, lon + medio_ancho)
+
+
+def caja_derivada(coordenadas):
+    # Limites a partir de las esquinas [lon, lat] que reporta plotly en
+    # relayoutData["mapbox._derived"]["coordinates"]
+    lons = [c[0] for c in coordenadas]
+    lats = [c[1] for c in coordenadas]
+    return (min(lats), max(lats), min(lons), max(lons))
+
+
+def ampliar(caja, margen=MARGEN_VISTA):
+    # Caja con margen, redondeada hacia afuera a centesimas de grado para
+    # que vistas parecidas compartan la misma caja (y el mismo cache)
+    sur, norte, oeste, este = caja
+    dy = (norte - sur) * margen
+    dx = (este - oeste) * margen
+    return (
+        float(np.floor((sur - dy) * 100) / 100),
+        float(np.ceil((norte + dy) * 100) / 100),
+        float(np.floor((oeste - dx) * 100) / 100),
+        float(np.ceil((este + dx) * 100) / 100),
+    )
+
+
+def contiene(externa, caja):
+    return (
+        externa[0] <= caja[0]
+        and caja[1] <= externa[1]
+        and externa[2] <= caja[2]
+        and caja[3] <= externa[3]
+    )
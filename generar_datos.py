@@ -0,0 +1,94 @@
+# Generador de datos sinteticos con el mismo esquema que DataSet_Telefonica.csv
+# Sirve para probar y medir la app sin el CSV real. Los sitios se reparten
+# alrededor de Monterrey y cada fila es un registro (sitio, dia, hora,
+# tecnologia, plan) con un consumo de bytes de distribucion log-normal.
+# Uso: python generar_datos.py --filas 10000000 --sitios 2000 --salida datos.csv
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import datos
+
+TECNOLOGIAS = (["2G", "3G", "LTE"], [0.1, 0.3, 0.6])
+TIPOS_PLAN = (["Prepago", "Pospago", "Hibrido"], [0.6, 0.3, 0.1])
+# Codigos de plan arbitrarios para los planes frecuentes; los poco
+# frecuentes son los que la limpieza agrupa en "Otro"
+PLANES_FRECUENTES = ["A1", "B4", "C7", "D2", "E9", "F3", "G5", "H8"]
+FRACCION_POCO_FRECUENTES = 0.02
+# Filas con hora nula, como en el dataset real
+FILAS_NULAS = 20
+
+
+def generar_sitios(n, semilla=0):
+    # Sitios concentrados cerca del centro de la ciudad
+    rng = np.random.default_rng(semilla)
+    return pd.DataFrame(
+        {
+            "sitio": ["S{:05d}".format(i) for i in range(n)],
+            "latitud": np.round(rng.normal(25.68, 0.06, n), 6),
+            "longitud": np.round(rng.normal(-100.31, 0.08, n), 6),
+        }
+    )
+
+
+def generar_bloque(rng, n, sitios, dias):
+    sitio = rng.integers(0, len(sitios), n)
+    frecuente = rng.random(n) >= FRACCION_POCO_FRECUENTES
+    plan = np.where(
+        frecuente,
+        rng.choice(PLANES_FRECUENTES, n),
+        rng.choice(datos.unpopular_plans, n),
+    )
+    return pd.DataFrame(
+        {
+            "sitio": sitios["sitio"].to_numpy()[sitio],
+            "latitud": sitios["latitud"].to_numpy()[sitio],
+            "longitud": sitios["longitud"].to_numpy()[sitio],
+            "fecha": dias[rng.integers(0, len(dias), n)],
+            "hora": rng.integers(0, 24, n).astype(float),
+            "tecnologia": rng.choice(TECNOLOGIAS[0], n, p=TECNOLOGIAS[1]),
+            "tipo_plan": rng.choice(TIPOS_PLAN[0], n, p=TIPOS_PLAN[1]),
+            "plan": plan,
+            "sum_bytes": rng.lognormal(13, 2, n).astype(np.int64),
+        }
+    )
+
+
+def generar(
+    ruta,
+    filas,
+    sitios=2000,
+    dias=33,
+    inicio="2019-10-04",
+    semilla=0,
+    tamano_bloque=datos.TAMANO_BLOQUE,
+):
+    # Escribe el CSV por bloques, asi la memoria no depende de filas
+    rng = np.random.default_rng(semilla)
+    tabla_sitios = generar_sitios(sitios, semilla)
+    fechas = pd.date_range(inicio, periods=dias, freq="D").strftime("%Y-%m-%d").to_numpy()
+    escritas = 0
+    while escritas < filas:
+        n = min(tamano_bloque, filas - escritas)
+        bloque = generar_bloque(rng, n, tabla_sitios, fechas)
+        if escritas == 0:
+            bloque.loc[: min(FILAS_NULAS, n) - 1, "hora"] = np.nan
+        bloque.to_csv(ruta, mode="w" if escritas == 0 else "a", header=escritas == 0, index=False)
+        escritas += n
+        print("  {} de {} filas".format(escritas, filas))
+    return ruta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera un CSV sintetico de Telefonica")
+    parser.add_argument("--filas", type=int, default=1_000_000)
+    parser.add_argument("--sitios", type=int, default=2000)
+    parser.add_argument("--dias", type=int, default=33)
+    parser.add_argument("--inicio", default="2019-10-04")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", default="DataSet_Sintetico.csv")
+    args = parser.parse_args()
+    print("Generando", args.salida)
+    generar(args.salida, args.filas, args.sitios, args.dias, args.inicio, args.semilla)
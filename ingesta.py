@@ -0,0 +1,29 @@
+# Anexa extractos diarios nuevos al cache del dataset
+# Solo se reescriben los archivos del dataset y se reagrupan las semanas
+# que aparecen en los extractos; el Sankey y los cubos que esten en cache se
+# actualizan sumando las filas nuevas, sin volver a leer el dataset.
+# Uso: python ingesta.py extracto1.csv [extracto2.csv ...]
+
+import sys
+
+import datos
+import sankey
+from cubo import anexar_cubos, cubos_vigentes
+
+
+def anexar(rutas):
+    sitios = datos.cargar_dataset()
+    df_master = datos.cargar_semanal(sitios)
+    enlaces = sankey.cargar_enlaces()
+    for ruta in rutas:
+        cubos = cubos_vigentes(sitios)
+        resultado = datos.anexar(ruta, sitios, df_master)
+        if resultado is None:
+            continue
+        sitios, df_master, nuevo = resultado
+        enlaces = sankey.anexar_enlaces(enlaces, nuevo)
+        anexar_cubos(cubos, nuevo, sitios)
+
+
+if __name__ == "__main__":
+    anexar(sys.argv[1:])
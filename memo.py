@@ -0,0 +1,168 @@
+# Cache de resultados de callbacks compartido entre procesos
+# Los resultados se guardan serializados en SQLite (cache/callbacks.sqlite),
+# con llave derivada de las entradas normalizadas y de la version de los datos.
+# Se desalojan por tiempo de vida (TTL) y por uso (LRU) al pasar del limite.
+# Un acierto solo lee: la hora de uso se actualiza a lo mas cada
+# refresco_usado segundos y los aciertos/fallos se cuentan en memoria y se
+# vuelcan en una sola transaccion cada volcar_cada segundos, para no pasar
+# por el candado de escritura de SQLite (comun a todos los workers) en
+# cada llamada.
+
+import atexit
+import collections
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS entradas (
+    llave TEXT PRIMARY KEY,
+    valor BLOB NOT NULL,
+    creado REAL NOT NULL,
+    usado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entradas_usado ON entradas (usado);
+CREATE TABLE IF NOT EXISTS contadores (
+    funcion TEXT PRIMARY KEY,
+    aciertos INTEGER NOT NULL DEFAULT 0,
+    fallos INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class CacheCallbacks:
+    def __init__(
+        self, ruta, version, max_entradas=256, ttl=3600, refresco_usado=60, volcar_cada=5
+    ):
+        # version: funcion que regresa la version actual de los datos,
+        # o None mientras no hay datos (en ese caso no se usa el cache)
+        self.ruta = ruta
+        self.version = version
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.refresco_usado = refresco_usado
+        self.volcar_cada = volcar_cada
+        self._local = threading.local()
+        # Contadores de este proceso aun no escritos: {(funcion, columna): n}
+        self._lock = threading.Lock()
+        self._pendientes = collections.Counter()
+        self._volcado = time.monotonic()
+        atexit.register(self._volcar)
+
+    def _conexion(self):
+        # Una conexion por hilo y por proceso (no se comparten tras un fork)
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            con = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            # Con WAL, NORMAL no sincroniza en cada commit y no corrompe la
+            # base; a lo mas se pierden las ultimas escrituras si se cae el
+            # sistema, que en un cache no importa
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.executescript(ESQUEMA)
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def _contar(self, funcion, acierto):
+        with self._lock:
+            self._pendientes[funcion, "aciertos" if acierto else "fallos"] += 1
+            toca = time.monotonic() - self._volcado >= self.volcar_cada
+        if toca:
+            self._volcar()
+
+    def _volcar(self):
+        # Escribe los contadores pendientes de este proceso en una transaccion
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, collections.Counter()
+            self._volcado = time.monotonic()
+        if not pendientes:
+            return
+        con = self._conexion()
+        with con:
+            con.execute("BEGIN")
+            for (funcion, columna), n in pendientes.items():
+                con.execute(
+                    "INSERT INTO contadores (funcion, {0}) VALUES (?, ?) "
+                    "ON CONFLICT(funcion) DO UPDATE SET {0} = {0} + ?".format(columna),
+                    (funcion, n, n),
+                )
+
+    def obtener(self, llave):
+        # Regresa (True, valor) si la llave esta vigente, (False, None) si no
+        con = self._conexion()
+        ahora = time.time()
+        fila = con.execute(
+            "SELECT valor, creado, usado FROM entradas WHERE llave = ?", (llave,)
+        ).fetchone()
+        if fila is None:
+            return False, None
+        if ahora - fila[1] > self.ttl:
+            con.execute("DELETE FROM entradas WHERE llave = ?", (llave,))
+            return False, None
+        # Para el LRU basta saber que se uso en el ultimo refresco_usado
+        if ahora - fila[2] >= self.refresco_usado:
+            con.execute("UPDATE entradas SET usado = ? WHERE llave = ?", (ahora, llave))
+        return True, pickle.loads(fila[0])
+
+    def guardar(self, llave, valor):
+        con = self._conexion()
+        ahora = time.time()
+        datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        con.execute(
+            "INSERT OR REPLACE INTO entradas (llave, valor, creado, usado) VALUES (?, ?, ?, ?)",
+            (llave, sqlite3.Binary(datos), ahora, ahora),
+        )
+        # Desalojar expiradas y las menos usadas recientemente
+        con.execute("DELETE FROM entradas WHERE creado < ?", (ahora - self.ttl,))
+        con.execute(
+            "DELETE FROM entradas WHERE llave IN "
+            "(SELECT llave FROM entradas ORDER BY usado DESC LIMIT -1 OFFSET ?)",
+            (self.max_entradas,),
+        )
+
+    def estadisticas(self):
+        # Incluye lo pendiente de este proceso; lo de otros workers aparece
+        # cuando lo vuelcan (a lo mas volcar_cada segundos despues)
+        self._volcar()
+        con = self._conexion()
+        funciones = {
+            funcion: {"aciertos": aciertos, "fallos": fallos}
+            for funcion, aciertos, fallos in con.execute(
+                "SELECT funcion, aciertos, fallos FROM contadores"
+            )
+        }
+        entradas = con.execute("SELECT COUNT(*) FROM entradas").fetchone()[0]
+        return {"entradas": entradas, "max_entradas": self.max_entradas, "funciones": funciones}
+
+    def memoizar(self, normalizar=None):
+        # normalizar: recibe los argumentos del callback y regresa lo que
+        # identifica al resultado (p. ej. sin argumentos que no afectan)
+        def decorador(funcion):
+            @functools.wraps(funcion)
+            def envoltura(*args):
+                version = self.version()
+                if version is None:
+                    return funcion(*args)
+                entradas = normalizar(*args) if normalizar else args
+                texto = json.dumps(
+                    [funcion.__name__, version, entradas], sort_keys=True, default=str
+                )
+                llave = hashlib.sha1(texto.encode("utf-8")).hexdigest()
+                acierto, valor = self.obtener(llave)
+                self._contar(funcion.__name__, acierto)
+                if acierto:
+                    return valor
+                valor = funcion(*args)
+                self.guardar(llave, valor)
+                return valor
+
+            return envoltura
+
+        return decorador
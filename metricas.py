@@ -0,0 +1,220 @@
+# Metricas del servidor en formato de texto de Prometheus
+# Duracion y filas de cada etapa de la carga (ingesta, limpieza, Sankey,
+# agregado semanal, cubos), histograma de latencia por callback, bytes de
+# las respuestas y aciertos del cache de figuras. Con gunicorn cada worker
+# lleva sus propias etapas y latencias; el cache es comun a todos.
+
+import contextlib
+import json
+import threading
+import time
+
+import flask
+
+# Limites (en segundos) de las cubetas del histograma de latencia
+LIMITES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Etapas:
+    # Ultima ejecucion de cada etapa de la carga de datos
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.etapas = {}
+
+    def registrar(self, nombre, segundos, filas=None):
+        with self._lock:
+            etapa = self.etapas.setdefault(nombre, {"ejecuciones": 0, "segundos_total": 0.0})
+            etapa["ejecuciones"] += 1
+            etapa["segundos_total"] += segundos
+            etapa["segundos"] = segundos
+            etapa["filas"] = filas
+
+    @contextlib.contextmanager
+    def medir(self, nombre):
+        # with etapas.medir("semanal") as etapa: ...; etapa["filas"] = n
+        etapa = {"filas": None}
+        inicio = time.perf_counter()
+        yield etapa
+        self.registrar(nombre, time.perf_counter() - inicio, etapa["filas"])
+
+    def resumen(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self.etapas.items()}
+
+
+# Compartido por los modulos de carga (datos, sankey, cubo, voronoi)
+etapas = Etapas()
+
+
+class MetricasCallbacks:
+    # Latencia de cada callback, desde que llega la peticion hasta que sale
+    # la respuesta (incluye serializar y comprimir). Si umbral_lento esta
+    # definido (segundos), las llamadas mas lentas se anexan como JSON a
+    # ruta_lentos junto con sus entradas.
+    def __init__(self, umbral_lento=None, ruta_lentos=None):
+        self._lock = threading.Lock()
+        self.umbral_lento = umbral_lento
+        self.ruta_lentos = ruta_lentos
+        self.callbacks = {}
+
+    def registrar(self, server):
+        server.before_request(self._inicio)
+        server.after_request_funcs.setdefault(None, []).insert(0, self._fin)
+
+    def _inicio(self):
+        flask.g.inicio_callback = time.perf_counter()
+
+    def _fin(self, respuesta):
+        if not flask.request.path.endswith("/_dash-update-component"):
+            return respuesta
+        segundos = time.perf_counter() - flask.g.get("inicio_callback", time.perf_counter())
+        cuerpo = flask.request.get_json(silent=True) or {}
+        salida = cuerpo.get("output")
+        if not salida:
+            return respuesta
+        with self._lock:
+            c = self.callbacks.setdefault(
+                salida, {"cubetas": [0] * len(LIMITES), "suma": 0.0, "llamadas": 0}
+            )
+            for i, limite in enumerate(LIMITES):
+                if segundos <= limite:
+                    c["cubetas"][i] += 1
+            c["suma"] += segundos
+            c["llamadas"] += 1
+        if self.umbral_lento is not None and segundos >= self.umbral_lento:
+            self._lento(salida, segundos, respuesta.status_code, cuerpo)
+        return respuesta
+
+    def resumen(self):
+        with self._lock:
+            return {k: dict(v, cubetas=list(v["cubetas"])) for k, v in self.callbacks.items()}
+
+    def _lento(self, salida, segundos, status, cuerpo):
+        registro = {
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "salida": salida,
+            "ms": round(segundos * 1000, 1),
+            "status": status,
+            "entradas": {
+                "{}.{}".format(e.get("id"), e.get("property")): e.get("value")
+                for e in cuerpo.get("inputs", [])
+                if isinstance(e, dict)
+            },
+        }
+        print("Callback lento: {} {} ms".format(salida, registro["ms"]))
+        if self.ruta_lentos:
+            with self._lock, open(self.ruta_lentos, "a") as f:
+                f.write(json.dumps(registro, default=str) + "\n")
+
+
+def etiqueta(valor):
+    # Escapa un valor de etiqueta de Prometheus
+    texto = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return '"{}"'.format(texto)
+
+
+def texto(callbacks=None, payloads=None, cache=None):
+    # Todas las metricas en formato de texto de Prometheus (version 0.0.4).
+    # payloads: MedidorPayloads.estadisticas(); cache: CacheCallbacks.estadisticas()
+    lineas = []
+
+    def metrica(nombre, tipo, ayuda, muestras):
+        lineas.append("# HELP {} {}".format(nombre, ayuda))
+        lineas.append("# TYPE {} {}".format(nombre, tipo))
+        for sufijo, etiquetas, valor in muestras:
+            campos = ",".join("{}={}".format(k, etiqueta(v)) for k, v in etiquetas.items())
+            lineas.append(
+                "{}{}{} {}".format(nombre, sufijo, "{" + campos + "}" if campos else "", valor)
+            )
+
+    registradas = etapas.resumen()
+    metrica(
+        "telefonica_etapa_segundos",
+        "gauge",
+        "Duracion de la ultima ejecucion de cada etapa de carga.",
+        [("", {"etapa": k}, v["segundos"]) for k, v in registradas.items()],
+    )
+    metrica(
+        "telefonica_etapa_segundos_total",
+        "counter",
+        "Tiempo acumulado de cada etapa de carga.",
+        [("", {"etapa": k}, v["segundos_total"]) for k, v in registradas.items()],
+    )
+    metrica(
+        "telefonica_etapa_ejecuciones_total",
+        "counter",
+        "Veces que se ha ejecutado cada etapa de carga.",
+        [("", {"etapa": k}, v["ejecuciones"]) for k, v in registradas.items()],
+    )
+    metrica(
+        "telefonica_etapa_filas",
+        "gauge",
+        "Filas producidas por la ultima ejecucion de cada etapa.",
+        [
+            ("", {"etapa": k}, v["filas"])
+            for k, v in registradas.items()
+            if v["filas"] is not None
+        ],
+    )
+
+    if callbacks is not None:
+        muestras = []
+        for salida, c in callbacks.resumen().items():
+            for limite, n in zip(LIMITES, c["cubetas"]):
+                muestras.append(("_bucket", {"salida": salida, "le": limite}, n))
+            muestras.append(("_bucket", {"salida": salida, "le": "+Inf"}, c["llamadas"]))
+            muestras.append(("_sum", {"salida": salida}, c["suma"]))
+            muestras.append(("_count", {"salida": salida}, c["llamadas"]))
+        metrica(
+            "telefonica_callback_segundos",
+            "histogram",
+            "Latencia de los callbacks por salida.",
+            muestras,
+        )
+
+    if payloads is not None:
+        medidos = payloads["callbacks"]
+        metrica(
+            "telefonica_callback_bytes_total",
+            "counter",
+            "Bytes de las respuestas de los callbacks antes de comprimir.",
+            [("", {"salida": k}, v["bytes"]) for k, v in medidos.items()],
+        )
+        metrica(
+            "telefonica_callback_bytes_red_total",
+            "counter",
+            "Bytes de las respuestas de los callbacks enviados por la red.",
+            [("", {"salida": k}, v["red"]) for k, v in medidos.items()],
+        )
+
+    if cache is not None:
+        funciones = cache["funciones"]
+        metrica(
+            "telefonica_cache_aciertos_total",
+            "counter",
+            "Aciertos del cache de figuras por funcion.",
+            [("", {"funcion": k}, v["aciertos"]) for k, v in funciones.items()],
+        )
+        metrica(
+            "telefonica_cache_fallos_total",
+            "counter",
+            "Fallos del cache de figuras por funcion.",
+            [("", {"funcion": k}, v["fallos"]) for k, v in funciones.items()],
+        )
+        metrica(
+            "telefonica_cache_tasa_aciertos",
+            "gauge",
+            "Fraccion de llamadas resueltas desde el cache por funcion.",
+            [
+                ("", {"funcion": k}, v["aciertos"] / (v["aciertos"] + v["fallos"]))
+                for k, v in funciones.items()
+                if v["aciertos"] + v["fallos"]
+            ],
+        )
+        metrica(
+            "telefonica_cache_entradas",
+            "gauge",
+            "Figuras guardadas en el cache.",
+            [("", {}, cache["entradas"])],
+        )
+    return "\n".join(lineas) + "\n"
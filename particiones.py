@@ -0,0 +1,199 @@
+# Dataset y agregado semanal particionados por fecha
+# cache/particiones/dataset/ (la escribe datos.py al ingerir el CSV) y
+# cache/particiones/semanal/ tienen un archivo Parquet por semana
+# (semana=AAAA-MM-DD, el lunes que cierra la semana W-mon, como el agregado
+# semanal) y, una vez compactadas, uno por mes (mes=AAAA-MM). Cada archivo
+# cubre un rango de dias conocido por su nombre, asi una consulta solo abre
+# los archivos que se cruzan con su rango.
+# Compactar une las semanas de los meses viejos en un archivo por mes; las
+# semanas que cruzan de un mes a otro se reparten entre los dos. Al cambiar
+# el agregado semanal solo se reescriben los archivos cuyo contenido cambio.
+# Uso (mejor con el servidor detenido, para que ninguna consulta vea una
+# compactacion a medias): python particiones.py --meses-detalle 3
+
+import argparse
+import hashlib
+import os
+
+import pandas as pd
+
+import datos
+from metricas import etapas
+
+
+def directorio(tabla, dir_cache=datos.DIR_CACHE):
+    return os.path.join(datos.ruta_cache("particiones", dir_cache), tabla)
+
+
+def ruta_meta(dir_cache=datos.DIR_CACHE):
+    return os.path.join(datos.ruta_cache("particiones", dir_cache), "particiones.json")
+
+
+def dias(ruta):
+    # (primer dia, ultimo dia) que puede contener una particion
+    clave, valor = os.path.splitext(os.path.basename(ruta))[0].split("=")
+    if clave == "semana":
+        fin = pd.Timestamp(valor)
+        return fin - pd.Timedelta(days=6), fin
+    mes = pd.Period(valor, freq="M")
+    return mes.start_time, mes.end_time.normalize()
+
+
+def listar(tabla, dir_cache=datos.DIR_CACHE):
+    return datos.listar_dataset(directorio(tabla, dir_cache))
+
+
+def seleccionar(tabla, inicio=None, fin=None, dir_cache=datos.DIR_CACHE):
+    # Particiones que se cruzan con [inicio, fin]; None es sin limite
+    elegidas = []
+    for ruta in listar(tabla, dir_cache):
+        primero, ultimo = dias(ruta)
+        if (fin is None or primero <= fin) and (inicio is None or ultimo >= inicio):
+            elegidas.append(ruta)
+    return elegidas
+
+
+def huella(df):
+    # Huella del contenido de una particion: si no cambia no se reescribe
+    valores = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.sha1(valores.tobytes()).hexdigest()
+
+
+def archivos_semanal(df_master, carpeta, meses_detalle=None):
+    # {archivo: filas} del agregado semanal (fecha es el lunes de la
+    # semana): cada semana va al archivo de su mes si el mes ya esta
+    # compactado o queda antes de los ultimos meses_detalle meses, igual
+    # que con compactar, y si no al archivo de la semana
+    compactados = set()
+    if os.path.isdir(carpeta):
+        compactados = {n for n in os.listdir(carpeta) if n.startswith("mes=")}
+    if meses_detalle is not None and len(df_master):
+        corte = df_master["fecha"].max().to_period("M") - meses_detalle
+        meses = pd.period_range(df_master["fecha"].min(), corte.start_time, freq="M")
+        compactados |= {datos.nombre_mes(mes) for mes in meses if mes < corte}
+    # Sin la columna "index" de df_master: cambia en todas las filas
+    # siguientes a una fila nueva y haria reescribir todo
+    df_master = df_master.drop(columns="index", errors="ignore")
+    archivos = {}
+    for semana, parte in df_master.groupby("fecha"):
+        mes = datos.nombre_mes(semana.to_period("M"))
+        nombre = mes if mes in compactados else datos.nombre_semana(semana)
+        archivos.setdefault(nombre, []).append(parte)
+    return {nombre: pd.concat(partes) for nombre, partes in archivos.items()}
+
+
+def escribir_semanal(df_master, huellas, meses_detalle=None, dir_cache=datos.DIR_CACHE):
+    # Escribe solo los archivos del agregado semanal cuyo contenido cambio
+    # respecto a huellas ({archivo: huella}) y borra los que ya no tienen
+    # filas; regresa las huellas nuevas y cuantos archivos se escribieron
+    carpeta = directorio("semanal", dir_cache)
+    os.makedirs(carpeta, exist_ok=True)
+    nuevas, escritos = {}, 0
+    for nombre, parte in archivos_semanal(df_master, carpeta, meses_detalle).items():
+        ruta = os.path.join(carpeta, nombre)
+        nuevas[nombre] = huella(parte)
+        if nuevas[nombre] != huellas.get(nombre) or not os.path.exists(ruta):
+            datos.guardar_particion(parte, ruta)
+            escritos += 1
+    for ruta in listar("semanal", dir_cache):
+        if os.path.basename(ruta) not in nuevas:
+            os.remove(ruta)
+    return nuevas, escritos
+
+
+def compactar(tabla, meses_detalle, dir_cache=datos.DIR_CACHE):
+    # Une en un archivo por mes las semanas anteriores a los ultimos
+    # meses_detalle meses con datos; regresa cuantos meses se compactaron
+    semanas = [r for r in listar(tabla, dir_cache) if os.path.basename(r).startswith("semana=")]
+    if not semanas:
+        return 0
+    ultimo = max(dias(r)[1] for r in listar(tabla, dir_cache))
+    corte = (ultimo.to_period("M") - meses_detalle).start_time
+    meses = sorted({m for r in semanas for m in meses_de(r) if m.start_time < corte})
+    carpeta = directorio(tabla, dir_cache)
+    for mes in meses:
+        # Las semanas del mes, mas el archivo del mes si ya existia
+        ruta_mes = os.path.join(carpeta, datos.nombre_mes(mes))
+        rutas = [r for r in semanas if os.path.exists(r) and mes in meses_de(r)]
+        partes = {r: pd.read_parquet(r) for r in rutas}
+        if os.path.exists(ruta_mes):
+            partes[ruta_mes] = pd.read_parquet(ruta_mes)
+        df = datos.concatenar(list(partes.values()))
+        en_mes = df["fecha"].dt.to_period("M") == mes
+        datos.guardar_particion(df[en_mes], ruta_mes)
+        # Lo que queda de cada semana es lo que cae en el mes siguiente
+        for ruta, parte in partes.items():
+            if ruta == ruta_mes:
+                continue
+            resto = parte[parte["fecha"].dt.to_period("M") != mes]
+            if len(resto):
+                datos.guardar_particion(resto, ruta)
+            else:
+                os.remove(ruta)
+    return len(meses)
+
+
+def meses_de(ruta):
+    primero, ultimo = dias(ruta)
+    return set(pd.period_range(primero, ultimo, freq="M"))
+
+
+def vigentes(dir_cache=datos.DIR_CACHE):
+    return datos.vigente(
+        ruta_meta(dir_cache),
+        datos.ruta_cache("dataset.json", dir_cache),
+        datos.ruta_cache("semanal.parquet", dir_cache),
+    )
+
+
+def cargar_particiones(dir_cache=datos.DIR_CACHE):
+    # Particiones del agregado semanal al dia, y las del dataset compactadas
+    # segun la ultima eleccion; regresa su meta (rango de dias, meses que
+    # se conservan por semana y huellas de los archivos del agregado)
+    meta = datos.leer_meta(ruta_meta(dir_cache))
+    if vigentes(dir_cache):
+        return meta
+
+    print("Actualizando particiones por semana")
+    meses_detalle = meta.get("meses_detalle")
+    with etapas.medir("particiones") as etapa:
+        df_master = pd.read_parquet(datos.ruta_cache("semanal.parquet", dir_cache))
+        huellas, escritos = escribir_semanal(
+            df_master, meta.get("huellas", {}), meses_detalle, dir_cache
+        )
+        etapa["filas"] = len(df_master)
+    print("  {} archivos del agregado semanal reescritos".format(escritos))
+    # Las filas nuevas del dataset ya van a los meses compactados
+    # (datos.fusionar); solo se compactan los meses que quedaron atras
+    if meses_detalle is not None:
+        compactar("dataset", meses_detalle, dir_cache)
+    meta = {
+        "dias": datos.leer_meta(datos.ruta_cache("dataset.json", dir_cache))["dias"],
+        "meses_detalle": meses_detalle,
+        "huellas": huellas,
+    }
+    datos.guardar_meta(meta, ruta_meta(dir_cache))
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compacta las particiones viejas por mes")
+    parser.add_argument(
+        "--meses-detalle",
+        type=int,
+        required=True,
+        help="meses mas recientes que se conservan con una particion por semana",
+    )
+    args = parser.parse_args()
+    if not vigentes():
+        raise SystemExit("Las particiones no estan al dia; arranque la app con duckdb primero")
+    print("dataset: {} meses compactados".format(compactar("dataset", args.meses_detalle)))
+    meta = datos.leer_meta(ruta_meta())
+    meta["huellas"], escritos = escribir_semanal(
+        pd.read_parquet(datos.ruta_cache("semanal.parquet")),
+        meta.get("huellas", {}),
+        args.meses_detalle,
+    )
+    print("semanal: {} archivos reescritos".format(escritos))
+    meta["meses_detalle"] = args.meses_detalle
+    datos.guardar_meta(meta, ruta_meta())
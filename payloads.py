@@ -0,0 +1,117 @@
+# Tamaño de las respuestas de los callbacks
+# Los arreglos de las figuras se envian como arreglos tipados en base64
+# ({"dtype", "bdata"}) en lugar de listas JSON, si el plotly.js que trae
+# Dash los entiende (v2.28 o posterior). Ademas se mide cuantos bytes
+# regresa cada callback, antes y despues de la compresion HTTP.
+
+import base64
+import os
+import re
+import threading
+
+import flask
+import numpy as np
+
+try:
+    from dash import dcc
+except ImportError:
+    import dash_core_components as dcc
+
+# Tipos de arreglo que entiende plotly.js (no hay enteros de 64 bits)
+TIPOS = {"f4": np.float32, "f8": np.float64, "i4": np.int32, "u1": np.uint8}
+
+
+def version_plotlyjs():
+    # Version del plotly.js que sirve Dash, de la cabecera del bundle
+    ruta = os.path.join(os.path.dirname(dcc.__file__), "plotly.min.js")
+    try:
+        with open(ruta) as f:
+            cabecera = f.read(200)
+    except OSError:
+        return (0, 0)
+    encontrado = re.search(r"plotly\.js v(\d+)\.(\d+)", cabecera)
+    return tuple(int(x) for x in encontrado.groups()) if encontrado else (0, 0)
+
+
+# TELEFONICA_BINARIO=0 fuerza listas JSON, p. ej. para comparar tamaños
+BINARIO = (
+    version_plotlyjs() >= (2, 28) and os.environ.get("TELEFONICA_BINARIO", "1") != "0"
+)
+
+
+def binario(valores, dtype):
+    # {"dtype": "f4", "bdata": "..."} con los bytes del arreglo
+    arreglo = np.ascontiguousarray(valores, dtype=TIPOS[dtype])
+    tipado = {"dtype": dtype, "bdata": base64.b64encode(arreglo.tobytes()).decode("ascii")}
+    if arreglo.ndim > 1:
+        tipado["shape"] = ",".join(str(n) for n in arreglo.shape)
+    return tipado
+
+
+def arreglo(valores, dtype):
+    # Un solo arreglo, tipado si el navegador lo soporta (p. ej. en un Patch)
+    return binario(valores, dtype) if BINARIO else np.asarray(valores)
+
+
+def empacar(fig, campos):
+    # campos: {(traza, "marker.color"): "f8", ...}. Regresa la figura como
+    # diccionario con esos arreglos tipados si el navegador los soporta.
+    # Siempre es un diccionario: guardado en el cache se recupera sin que
+    # plotly vuelva a validar cada propiedad, como pasaria con un go.Figure
+    figura = fig.to_plotly_json()
+    if not BINARIO:
+        return figura
+    for (traza, ruta), dtype in campos.items():
+        nodo = figura["data"][traza]
+        *padres, hoja = ruta.split(".")
+        for padre in padres:
+            nodo = nodo[padre]
+        nodo[hoja] = binario(nodo[hoja], dtype)
+    return figura
+
+
+class MedidorPayloads:
+    # Bytes por callback: "bytes" es el JSON que arma Dash y "red" lo que
+    # sale por el socket (despues de la compresion, si esta activa)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.callbacks = {}
+
+    def registrar(self, server):
+        # Flask corre los after_request en orden inverso al de registro:
+        # el primero mide antes de comprimir y el segundo al final
+        server.after_request(self._antes)
+        server.after_request_funcs.setdefault(None, []).insert(0, self._despues)
+
+    def _salida(self):
+        if flask.request.path.endswith("/_dash-update-component"):
+            return (flask.request.get_json(silent=True) or {}).get("output")
+        return None
+
+    def _antes(self, respuesta):
+        salida = self._salida()
+        if salida and not respuesta.direct_passthrough:
+            flask.g.bytes_callback = len(respuesta.get_data())
+        return respuesta
+
+    def _despues(self, respuesta):
+        salida = self._salida()
+        if salida and not respuesta.direct_passthrough:
+            red = len(respuesta.get_data())
+            with self._lock:
+                c = self.callbacks.setdefault(salida, {"llamadas": 0, "bytes": 0, "red": 0})
+                c["llamadas"] += 1
+                c["bytes"] += flask.g.get("bytes_callback", red)
+                c["red"] += red
+        return respuesta
+
+    def estadisticas(self):
+        with self._lock:
+            callbacks = {}
+            for salida, c in self.callbacks.items():
+                callbacks[salida] = dict(
+                    c,
+                    bytes_promedio=c["bytes"] // c["llamadas"],
+                    red_promedio=c["red"] // c["llamadas"],
+                )
+        return {"binario": BINARIO, "callbacks": callbacks}
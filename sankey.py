@@ -0,0 +1,139 @@
+# Diagrama Sankey: tecnologia -> tipo de plan -> plan
+# La figura terminada se guarda como JSON junto al cache del dataset,
+# asi la pestaña de Analisis no recalcula los groupbys en cada arranque.
+
+import os
+
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+
+import datos
+from metricas import etapas
+
+# Niveles del diagrama, de izquierda a derecha
+NIVELES = [("tecnologia", "tipo_plan"), ("tipo_plan", "plan")]
+
+# Peso de los enlaces: numero de registros o bytes consumidos
+PESOS = ("registros", "sum_bytes")
+
+
+def validar_peso(peso):
+    if peso not in PESOS:
+        raise ValueError("Peso desconocido: {} (opciones: {})".format(peso, PESOS))
+    return peso
+
+
+def enlaces_sankey(df):
+    # Registros y bytes por cada par de niveles consecutivos
+    partes = []
+    for a, b in NIVELES:
+        g = df.groupby([a, b], observed=True)[["registros", "sum_bytes"]].sum()
+        g = g.reset_index()
+        partes.append(
+            pd.DataFrame(
+                {
+                    "nivel_a": a,
+                    "a": g[a].astype(str),
+                    "nivel_b": b,
+                    "b": g[b].astype(str),
+                    "registros": g["registros"],
+                    "sum_bytes": g["sum_bytes"],
+                }
+            )
+        )
+    return pd.concat(partes, ignore_index=True)
+
+
+def figura_sankey(enlaces, peso="registros"):
+    # Cada nodo se identifica por (nivel, etiqueta) para que una etiqueta
+    # repetida en dos niveles no se confunda; los ids se asignan en orden
+    # de aparicion con un diccionario
+    ids = {}
+    source_indices = [
+        ids.setdefault(llave, len(ids)) for llave in zip(enlaces["nivel_a"], enlaces["a"])
+    ]
+    target_indices = [
+        ids.setdefault(llave, len(ids)) for llave in zip(enlaces["nivel_b"], enlaces["b"])
+    ]
+    all_nodes = [etiqueta for _, etiqueta in ids]
+
+    fig = go.Figure(
+        data=[
+            go.Sankey(
+                node=dict(
+                    pad=20,
+                    thickness=20,
+                    line=dict(color="black", width=1.0),
+                    label=all_nodes,
+                ),
+                link=dict(
+                    source=source_indices,
+                    target=target_indices,
+                    value=enlaces[peso].to_numpy(),
+                ),
+            )
+        ]
+    )
+
+    fig.update_layout(
+        title_text="Tecnologias y Planes en Telefonica",
+        font=dict(size=10, color="white"),
+        plot_bgcolor="red",
+        paper_bgcolor="#343332",
+    )
+    return fig
+
+
+def sumar_enlaces(tablas):
+    # Suma enlaces parciales; quedan por nivel (en el orden de NIVELES) y
+    # por etiquetas, igual que con un solo groupby sobre todo el dataset
+    enlaces = pd.concat(tablas, ignore_index=True)
+    enlaces = enlaces.groupby(["nivel_a", "a", "nivel_b", "b"], as_index=False, sort=False)[
+        ["registros", "sum_bytes"]
+    ].sum()
+    orden = enlaces["nivel_a"].map({a: i for i, (a, _) in enumerate(NIVELES)})
+    enlaces = enlaces.assign(orden=orden).sort_values(["orden", "a", "b"])
+    return enlaces.drop(columns="orden").reset_index(drop=True)
+
+
+def cargar_enlaces(dir_cache=datos.DIR_CACHE):
+    # Tabla de enlaces desde cache mientras sea tan reciente como el dataset;
+    # se arma un archivo del dataset a la vez
+    ruta = datos.ruta_cache("sankey_enlaces.parquet", dir_cache)
+    if datos.vigente(ruta, datos.ruta_cache("dataset.json", dir_cache)):
+        return pd.read_parquet(ruta)
+    print("Construyendo enlaces del Sankey")
+    with etapas.medir("sankey") as etapa:
+        enlaces = sumar_enlaces(
+            [enlaces_sankey(parte) for parte in datos.partes_dataset(dir_cache)]
+        )
+        etapa["filas"] = len(enlaces)
+    datos.guardar_parquet(enlaces, ruta)
+    return enlaces
+
+
+def anexar_enlaces(enlaces, nuevo, dir_cache=datos.DIR_CACHE):
+    # Suma los conteos de las filas nuevas a los enlaces existentes
+    enlaces = sumar_enlaces([enlaces, enlaces_sankey(nuevo)])
+    datos.guardar_parquet(enlaces, datos.ruta_cache("sankey_enlaces.parquet", dir_cache))
+    return enlaces
+
+
+def cargar_sankey(peso="registros", dir_cache=datos.DIR_CACHE):
+    # Usa la figura guardada si es tan reciente como sus enlaces
+    enlaces = datos.ruta_cache("sankey_enlaces.parquet", dir_cache)
+    ruta = datos.ruta_cache("sankey_{}.json".format(peso), dir_cache)
+    if datos.vigente(enlaces, datos.ruta_cache("dataset.json", dir_cache)) and datos.vigente(
+        ruta, enlaces
+    ):
+        print("Cargando Sankey desde cache")
+        with open(ruta) as f:
+            return pio.from_json(f.read())
+
+    print("Construyendo Sankey")
+    fig = figura_sankey(cargar_enlaces(dir_cache), peso)
+    with open(ruta + ".tmp", "w") as f:
+        f.write(fig.to_json())
+    os.replace(ruta + ".tmp", ruta)
+    return fig
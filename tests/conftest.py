@@ -0,0 +1,57 @@
+# Dataset sintetico compartido por las pruebas
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datos
+
+TECNOLOGIAS = ["2G", "3G", "LTE"]
+PLANES = ["Hibrido", "Pospago", "Prepago"]
+
+
+@pytest.fixture(scope="session")
+def crear_dataset(tmp_path_factory):
+    # crear_dataset(semilla, inicio, fin, n) escribe en un cache nuevo un
+    # dataset pre-agregado y particionado por semana, como el que deja
+    # datos.cargar_dataset (con su meta), de n registros entre inicio y fin;
+    # regresa (dir_cache, sitios, dias)
+    def crear(semilla, inicio, fin, n):
+        rng = np.random.default_rng(semilla)
+        sitios = pd.DataFrame(
+            {
+                "sitio": ["S{:02d}".format(i) for i in range(8)],
+                "latitud": np.linspace(25.6, 25.8, 8).astype("float32"),
+                "longitud": np.linspace(-100.4, -100.2, 8).astype("float32"),
+            }
+        )
+        dias = pd.date_range(inicio, fin, freq="D")
+        df = pd.DataFrame(
+            {
+                "sitio": pd.Categorical(rng.choice(sitios["sitio"], n)),
+                "fecha": dias[rng.integers(0, len(dias), n)],
+                "hora": rng.integers(0, 24, n).astype("int8"),
+                "tecnologia": pd.Categorical(rng.choice(TECNOLOGIAS, n)),
+                "tipo_plan": pd.Categorical(rng.choice(PLANES, n)),
+                "plan": pd.Categorical(rng.choice(["A1", "B4", "Otro"], n)),
+                "sum_bytes": rng.integers(1, 10 ** 9, n).astype("int64"),
+                "registros": np.ones(n, dtype="int64"),
+            }
+        )
+        df = df.groupby(datos.LLAVES, observed=True, as_index=False)[
+            ["sum_bytes", "registros"]
+        ].sum()
+
+        dir_cache = str(tmp_path_factory.mktemp("cache"))
+        carpeta = datos.ruta_dataset(dir_cache)
+        os.makedirs(carpeta)
+        for semana, parte in df.groupby(datos.lunes(df["fecha"])):
+            datos.guardar_particion(parte, os.path.join(carpeta, datos.nombre_semana(semana)))
+        datos.guardar_meta(
+            {"dias": datos.rango_dias(carpeta)}, datos.ruta_cache("dataset.json", dir_cache)
+        )
+        return dir_cache, sitios, dias.to_numpy()
+
+    return crear
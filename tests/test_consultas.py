@@ -0,0 +1,80 @@
+# El backend DuckDB (particiones por fecha) debe dar los mismos totales que
+# el cubo diario, con y sin meses compactados.
+
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datos
+import particiones
+from cubo import Cubo, CuboDiario, CuboHorario
+
+duckdb = pytest.importorskip("duckdb")
+
+import consultas  # noqa: E402
+
+
+@pytest.fixture(scope="module", params=[None, 1], ids=["por_semana", "compactado"])
+def backends(request, crear_dataset):
+    # Cache con el dataset particionado por semana, como lo deja
+    # datos.cargar_dataset; con params=1 se compactan los meses viejos
+    dir_cache, sitios, _ = crear_dataset(11, "2019-10-03", "2019-12-18", 4000)
+    cubo = Cubo.construir(datos.cargar_semanal(sitios, dir_cache), sitios)
+    consulta = consultas.cargar_consulta_duckdb(cubo.sitios, dir_cache)
+    if request.param is not None:
+        particiones.compactar("dataset", request.param, dir_cache)
+        df_master = pd.read_parquet(datos.ruta_cache("semanal.parquet", dir_cache))
+        particiones.escribir_semanal(df_master, {}, request.param, dir_cache)
+        assert any("mes=" in r for r in particiones.listar("semanal", dir_cache))
+    dias = datos.dias_dataset(dir_cache)
+    diario = CuboDiario.construir(datos.partes_dataset(dir_cache), cubo, dias)
+    horario = CuboHorario.construir(datos.partes_dataset(dir_cache), cubo, dias)
+    return cubo, diario, horario, consulta
+
+
+RANGOS = [
+    (None, None),
+    ("2019-10-03", "2019-10-03"),
+    ("2019-10-05", "2019-11-12"),
+    ("2019-10-29", "2019-12-01"),
+    ("2019-11-05", None),
+    (None, "2019-10-20"),
+    ("2019-12-19", "2019-12-30"),
+]
+FILTROS = [None, ["LTE"], ["2G", "3G"]]
+PLANES_FILTRO = [None, ["Prepago"], ["Hibrido", "Pospago"]]
+
+
+@pytest.mark.parametrize("rango", RANGOS)
+def test_por_sitio(backends, rango):
+    cubo, diario, _, consulta = backends
+    assert list(consulta.sitios) == diario.sitios
+    for tecnologia, plan, indices in itertools.product(
+        FILTROS, PLANES_FILTRO, [None, np.array([0, 3, 5])]
+    ):
+        esperado = diario.por_sitio(*rango, tecnologia, plan, indices)
+        obtenido = consulta.por_sitio(*rango, tecnologia, plan, indices)
+        np.testing.assert_array_equal(obtenido[0], esperado[0])
+        np.testing.assert_array_equal(obtenido[1], esperado[1])
+
+
+@pytest.mark.parametrize("rango", RANGOS)
+def test_por_semana(backends, rango):
+    cubo, diario, _, consulta = backends
+    for tecnologia, plan in itertools.product(FILTROS, PLANES_FILTRO):
+        np.testing.assert_array_equal(
+            consulta.por_semana(cubo.semanas, *rango, tecnologia, plan),
+            diario.por_semana(cubo.semanas, *rango, tecnologia, plan),
+        )
+
+
+@pytest.mark.parametrize("sitios", [None, [], ["S01"], ["S02", "S06", "S99"], ["S99"]])
+def test_por_dia_hora(backends, sitios):
+    _, _, horario, consulta = backends
+    for tecnologia, plan in itertools.product(FILTROS + ["5G"], PLANES_FILTRO):
+        np.testing.assert_array_equal(
+            consulta.por_dia_hora(tecnologia, plan, sitios),
+            horario.por_dia_hora(tecnologia, plan, sitios),
+        )
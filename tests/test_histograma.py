@@ -0,0 +1,80 @@
+# El histograma semanal debe dar los mismos valores que la implementacion
+# original: filtrar df_master con mascaras, agrupar y sumar semana por semana.
+
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datos
+from cubo import Cubo, CuboDiario
+
+
+@pytest.fixture(scope="module")
+def dataset(crear_dataset):
+    # Dataset con semanas incompletas al principio y al final
+    dir_cache, sitios, dias = crear_dataset(7, "2019-10-03", "2019-11-05", 3000)
+    rutas = datos.listar_dataset(datos.ruta_dataset(dir_cache))
+    df_master = datos.agrupar_por_semana(rutas, sitios, procesos=1)
+    cubo = Cubo.construir(df_master, sitios)
+    partes = datos.partes_dataset(dir_cache)
+    return df_master, cubo, CuboDiario.construir(partes, cubo, dias)
+
+
+def serie_original(df_master, semana, tecnologia, plan):
+    # get_selection antes del cubo: mascaras sobre df_master, groupby y una
+    # suma por semana
+    df_sub = df_master
+    if semana is not None:
+        df_sub = df_sub[df_sub["fecha"] == semana]
+    if tecnologia is not None:
+        df_sub = df_sub[df_sub["tecnologia"] == tecnologia]
+    if plan is not None:
+        df_sub = df_sub[df_sub["tipo_plan"] == plan]
+    df_sub = df_sub.groupby(["tipo_plan", "tecnologia", "fecha"], observed=True).agg(
+        {"sum_bytes": "sum"}
+    )
+    df_sub = df_sub.reset_index()
+    semanas = np.sort(df_master["fecha"].unique())
+    return semanas, np.array([df_sub[df_sub["fecha"] == s]["sum_bytes"].sum() for s in semanas])
+
+
+def combinaciones(df_master):
+    # Cada semana (y ninguna), cada tecnologia y plan, valores que no
+    # existen y None
+    semanas = [None] + list(np.sort(df_master["fecha"].unique()))
+    tecnologias = [None, "5G"] + sorted(df_master["tecnologia"].unique())
+    planes = [None, "Empresarial"] + sorted(df_master["tipo_plan"].unique())
+    return itertools.product(semanas, tecnologias, planes)
+
+
+def rango(semana):
+    # Una semana W-mon va de martes al lunes que la etiqueta
+    if semana is None:
+        return None, None
+    lunes = pd.Timestamp(semana)
+    return str(lunes - pd.Timedelta(days=6))[:10], str(lunes)[:10]
+
+
+def test_por_semana_igual_al_original(dataset):
+    df_master, cubo, diario = dataset
+    for semana, tecnologia, plan in combinaciones(df_master):
+        semanas, esperado = serie_original(df_master, semana, tecnologia, plan)
+        obtenido = diario.por_semana(cubo.semanas, *rango(semana), tecnologia, plan)
+        assert np.array_equal(cubo.semanas, semanas)
+        assert np.array_equal(obtenido, esperado), (semana, tecnologia, plan)
+
+
+def test_get_selection_igual_al_original(dataset, monkeypatch):
+    pytest.importorskip("dash")
+    import TelefonicaMapa_v5 as app
+
+    df_master, cubo, diario = dataset
+    monkeypatch.setitem(app.estado, "cubo", cubo)
+    monkeypatch.setitem(app.estado, "consulta", diario)
+    for semana, tecnologia, plan in combinaciones(df_master):
+        semanas, esperado = serie_original(df_master, semana, tecnologia, plan)
+        xVal, yVal, _ = app.get_selection(*rango(semana), tecnologia, plan)
+        assert list(xVal) == [str(s)[:10] for s in semanas]
+        assert np.array_equal(yVal, esperado), (semana, tecnologia, plan)
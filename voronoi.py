@@ -0,0 +1,142 @@
+# Cobertura de las radio bases: teselacion de Voronoi de los sitios
+# Se calcula una sola vez en el servidor y se guarda como GeoJSON junto al
+# cache del dataset; los filtros solo cambian el color de cada poligono.
+
+import json
+import os
+
+import numpy as np
+
+import datos
+from metricas import etapas
+
+try:
+    from scipy.spatial import Voronoi
+except ImportError:
+    Voronoi = None
+
+
+class Teselacion:
+    def __init__(self, geojson, sitios):
+        # sitios: nombres alineados con el eje de sitios del cubo; poligono[i]
+        # es la posicion del poligono (feature) que cubre al sitio i, o -1 si
+        # su poligono se descarto (menos de tres vertices tras recortarlo)
+        self.geojson = geojson
+        posicion = {str(s): i for i, s in enumerate(sitios)}
+        self.poligono = np.full(len(sitios), -1, dtype=np.intp)
+        for k, feature in enumerate(geojson["features"]):
+            for nombre in feature["properties"]["sitios"]:
+                if nombre in posicion:
+                    self.poligono[posicion[nombre]] = k
+        self.etiquetas = [", ".join(f["properties"]["sitios"]) for f in geojson["features"]]
+
+    def por_poligono(self, total):
+        # Suma por poligono del consumo por sitio; los sitios sin poligono
+        # no cuentan
+        cubiertos = self.poligono >= 0
+        return np.bincount(
+            self.poligono[cubiertos],
+            weights=np.asarray(total)[cubiertos],
+            minlength=len(self.etiquetas),
+        )
+
+
+def teselar(sitios):
+    # FeatureCollection con un poligono por ubicacion distinta (sitios con
+    # las mismas coordenadas comparten poligono)
+    lat = sitios["latitud"].to_numpy(dtype=np.float64)
+    lon = sitios["longitud"].to_numpy(dtype=np.float64)
+    nombres = sitios["sitio"].astype(str).to_numpy()
+
+    # Coordenadas planas aproximadas: un grado de longitud mide cos(lat)
+    escala = np.cos(np.radians(lat.mean()))
+    puntos, ubicacion = np.unique(
+        np.column_stack((lon * escala, lat)), axis=0, return_inverse=True
+    )
+    ubicacion = ubicacion.ravel()
+
+    # Los poligonos se recortan a la caja de los sitios mas un margen; cuatro
+    # puntos lejanos hacen que todas las regiones de los sitios sean finitas
+    minimo, maximo = puntos.min(axis=0), puntos.max(axis=0)
+    margen = np.maximum((maximo - minimo) * 0.1, 0.01)
+    caja = (minimo - margen, maximo + margen)
+    lejos = (maximo - minimo).max() * 10 + 1
+    centro = (minimo + maximo) / 2
+    esquinas = centro + lejos * np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]])
+    vor = Voronoi(np.vstack((puntos, esquinas)))
+
+    features = []
+    for k in range(len(puntos)):
+        region = [v for v in vor.regions[vor.point_region[k]] if v >= 0]
+        anillo = recortar(ordenar(vor.vertices[region]), *caja)
+        if len(anillo) < 3:
+            continue
+        # Anillo cerrado, de vuelta a grados
+        anillo = np.vstack((anillo, anillo[:1]))
+        anillo = np.round(np.column_stack((anillo[:, 0] / escala, anillo[:, 1])), 6)
+        features.append(
+            {
+                "type": "Feature",
+                "id": len(features),
+                "properties": {"sitios": sorted(nombres[ubicacion == k].tolist())},
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [anillo.tolist()],
+                },
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def ordenar(vertices):
+    # Vertices de un poligono convexo en sentido antihorario
+    centro = vertices.mean(axis=0)
+    angulo = np.arctan2(vertices[:, 1] - centro[1], vertices[:, 0] - centro[0])
+    return vertices[np.argsort(angulo)]
+
+
+def recortar(poligono, minimo, maximo):
+    # Sutherland-Hodgman contra la caja [minimo, maximo]
+    for eje, limite, signo in (
+        (0, minimo[0], 1),
+        (0, maximo[0], -1),
+        (1, minimo[1], 1),
+        (1, maximo[1], -1),
+    ):
+        salida = []
+        for i in range(len(poligono)):
+            a, b = poligono[i - 1], poligono[i]
+            dentro_a = signo * (a[eje] - limite) >= 0
+            dentro_b = signo * (b[eje] - limite) >= 0
+            if dentro_a != dentro_b:
+                t = (limite - a[eje]) / (b[eje] - a[eje])
+                salida.append(a + t * (b - a))
+            if dentro_b:
+                salida.append(b)
+        poligono = np.array(salida)
+        if len(poligono) == 0:
+            break
+    return poligono
+
+
+def cargar_voronoi(sitios, dir_cache=datos.DIR_CACHE):
+    # Teselacion desde cache mientras sea tan reciente como la tabla de
+    # sitios (anexar datos de sitios conocidos no la cambia); sin scipy (y
+    # sin cache) no hay capa de cobertura
+    ruta = datos.ruta_cache("voronoi.geojson", dir_cache)
+    nombres = sitios["sitio"].astype(str).tolist()
+    if datos.vigente(ruta, datos.ruta_cache("sitios.parquet", dir_cache)):
+        with open(ruta) as f:
+            return Teselacion(json.load(f), nombres)
+    if Voronoi is None:
+        print("scipy no esta instalado; no se construye la capa de Voronoi")
+        return None
+
+    print("Construyendo teselacion de Voronoi")
+    with etapas.medir("voronoi") as etapa:
+        geojson = teselar(sitios)
+        etapa["filas"] = len(geojson["features"])
+    with open(ruta + ".tmp", "w") as f:
+        json.dump(geojson, f)
+    os.replace(ruta + ".tmp", ruta)
+    return Teselacion(geojson, nombres)
@@ -0,0 +1,9 @@
+# Punto de entrada WSGI para un servidor con pre-fork, p. ej.:
+#   gunicorn --preload --workers 4 --bind 0.0.0.0:8050 wsgi:server
+# Con --preload los datos se cargan una vez en el proceso maestro y los
+# workers comparten los cubos de cache/ (mapeados a memoria, solo lectura).
+
+from TelefonicaMapa_v5 import crear_app
+
+app = crear_app()
+server = app.server